@@ -0,0 +1,349 @@
+#!/bin/python
+#Copyright (c) 2012, The Children's Hospital of Philadelphia All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+#following conditions are met:
+#
+#1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+#   disclaimer.
+#
+#2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+#INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+#SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+#USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Measures how redcap_repeat scales on synthetic data dictionaries.
+#
+#   python benchmark.py --rows 5000 --max_depth 2 --times 20 -o results.json
+#
+# Each prompt mode is run in its own process so the peak memory reported belongs to that mode alone.
+# --startup times how long a fresh interpreter takes to import the module and to run the script on a tiny
+# dictionary, which is what matters when the script is called thousands of times from build tooling.
+
+import os
+import csv
+import sys
+import json
+import time
+import random
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+from StringIO import StringIO
+
+import redcap_repeat
+from redcap_repeat import key, Expander, read_rows, preprocess, expand_groups, write_rows, main
+
+header = ["Variable / Field Name", "Form Name", "Section Header", "Field Type", "Field Label",
+        "Choices, Calculations, OR Slider Labels", "Field Note", "Text Validation Type OR Show Slider Number",
+        "Text Validation Min", "Text Validation Max", "Identifier?", "Branching Logic (Show field only if...)",
+        "Required Field?", "Custom Alignment", "Question Number (surveys only)", "Matrix Group Name"]
+
+# The field types the generator picks from and the choices each one needs to be valid
+choice_types = {
+    'radio': "1, Yes | 2, No | 3, Unknown",
+    'checkbox': "1, Pill | 2, Liquid | 3, Injection",
+    'checkbox_other': "1, Mom | 2, Dad | 3, Other",
+    'checkbox_details': "1, Rash | 2, Fever",
+    'radio_details': "1, Mild | 2, Severe",
+    'dropdown_other': "1, Clinic | 2, Home | 3, Other",
+    'checkbox_mutex_other': "1, Fever | 2, Cough | 3, Rash | 4, None | 5, Other",
+    'checkbox_mutex': "1, Fever | 2, Cough | 3, Unknown",
+}
+default_types = ["text", "text", "text", "radio", "checkbox", "checkbox_other", "checkbox_mutex_other", "radio_details",
+        "minmax", "value_with_units", "value_with_units_and_minmax", "value_with_weight_units", "age_weeks_days"]
+
+modes = ['default', 'prompt', 'auto']
+
+
+class BenchmarkOptions:
+    auto = False
+    prompt = False
+    validation_off = False
+    groups = False
+    max_repeat = 10
+    simplify_logic = False
+    plurals = None
+    group_jobs = None
+    max_fields = None
+    native = False
+
+    def __init__(self, mode):
+        self.auto = mode == "auto"
+        self.prompt = mode == "prompt"
+
+
+def generate_dictionary(rows=1000, max_depth=1, times=5, group_ratio=0.3, group_size=4, other_id=0.2,
+        logic_density=0.3, types=None, forms=5, seed=1):
+    """Builds a synthetic data dictionary of roughly the given number of input rows (header included).
+
+    group_ratio is the chance that the next item is a repeating group rather than a plain field, group_size the
+    number of lines in each group and max_depth how deeply groups nest. Each group repeats `times` times, or
+    with a probability of other_id, as many times as the maximum of a count field placed just before it
+    ([other_id] syntax). logic_density is the chance a field gets branching logic referring to an earlier
+    field, and types the field types to choose from."""
+    rand = random.Random(seed)
+    types = types or default_types
+    names = []
+    counter = [0]
+    dictionary = [header[:]]
+
+    def new_name(templated=False):
+        counter[0] += 1
+        if templated:
+            return "fld${d}_%d" % counter[0]
+        return "fld%d" % counter[0]
+
+    def form_name():
+        return "form_%d" % (len(dictionary) * forms // max(rows, 1) + 1)
+
+    def logic(visible):
+        if not visible or rand.random() >= logic_density:
+            return ""
+        terms = []
+        for i in range(rand.randint(1, 2)):
+            name = rand.choice(visible[-20:])
+            if rand.random() < 0.3:
+                terms.append("[%s(1)] = '1'" % name)
+            else:
+                terms.append("[%s] <> ''" % name)
+        return " and ".join(terms)
+
+    def field(name, visible, kind=None):
+        kind = kind or rand.choice(types)
+        label = rand.choice(["Field %s" % name, "$s entry of %s" % name, "Value $placeholder"])
+        if kind in ("checkbox_other", "checkbox_details", "radio_details", "dropdown_other"):
+            label = "Field %s" % name
+        return [name, form_name(), "", kind, label, choice_types.get(kind, ""), "", "", "", "", "",
+                logic(visible), "", "", "", ""]
+
+    def count_field(visible):
+        name = new_name()
+        row = [name, form_name(), "", "text", "How many for %s" % name, "", "", "integer", "0", str(times), "",
+                logic(visible), "", "", "", ""]
+        return name, row
+
+    def group(depth, visible):
+        lines = []
+        count = str(times)
+        if rand.random() < other_id:
+            name, row = count_field(visible)
+            lines.append(row)
+            visible = visible + [name]
+            count = "[%s]" % name
+        group_name = "Group %d" % counter[0]
+        size = max(1, group_size)
+        members = []
+        for index in range(size):
+            if index > 0 and depth < max_depth and rand.random() < group_ratio:
+                members.append(group(depth + 1, visible))
+                continue
+            name = new_name(templated=rand.random() < 0.2)
+            row = field(name, visible)
+            visible = visible + [name]
+            members.append([row])
+        # The first line of a group opens it, and the group is closed on its last line or by a blank endrepeat row
+        first = members[0][0]
+        if len(members) == 1 and len(members[0]) == 1:
+            first[key['a']] = "%s repeat %s %s" % (first[key['a']], count, group_name)
+            return lines + members[0]
+        first[key['a']] = "%s startrepeat %s %s" % (first[key['a']], count, group_name)
+        for member in members:
+            lines.extend(member)
+        if len(members[-1]) > 1 or " repeat " in members[-1][0][key['a']]:
+            lines.append([" endrepeat"] + [""] * (len(header) - 1))
+        else:
+            lines[-1][key['a']] = lines[-1][key['a']] + " endrepeat"
+        return lines
+
+    while len(dictionary) < rows:
+        if rand.random() < group_ratio:
+            dictionary.extend(group(1, names))
+        else:
+            name = new_name()
+            dictionary.append(field(name, names))
+            names.append(name)
+    return dictionary
+
+
+def peak_memory_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    if sys.platform == "darwin":
+        usage = usage // 1024
+    return usage
+
+
+def run_mode(mode, settings, queue):
+    """Runs one mode in this (child) process and puts its measurements on the queue"""
+    dictionary = generate_dictionary(**settings)
+    text = StringIO()
+    csv.writer(text).writerows(dictionary)
+    source = text.getvalue()
+    expander = Expander(BenchmarkOptions(mode))
+
+    # Time each stage on its own by running it to completion before starting the next
+    stages = {}
+    started = time.time()
+    rows = list(read_rows(StringIO(source)))
+    stages['read'] = time.time() - started
+
+    started = time.time()
+    preprocessed = list(preprocess(rows))
+    stages['preprocess'] = time.time() - started
+
+    started = time.time()
+    expanded = list(expand_groups(preprocessed, expander))
+    stages['expand'] = time.time() - started
+
+    started = time.time()
+    write_rows(open(os.devnull, 'wb'), expanded)
+    stages['write'] = time.time() - started
+
+    # And the streaming pipeline end to end, which is what users actually run
+    started = time.time()
+    main(StringIO(source), open(os.devnull, 'wb'), expander)
+    seconds = time.time() - started
+
+    queue.put({
+        'input_rows': len(rows),
+        'output_rows': len(expanded),
+        'seconds': seconds,
+        'input_rows_per_sec': len(rows) / seconds if seconds else None,
+        'output_rows_per_sec': len(expanded) / seconds if seconds else None,
+        'stages': stages,
+        'peak_memory_kb': peak_memory_kb(),
+    })
+
+
+def benchmark(settings, run_modes=modes, repeat=1):
+    """Runs every mode `repeat` times and keeps the fastest run of each"""
+    results = {}
+    for mode in run_modes:
+        best = None
+        for i in range(repeat):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_mode, args=(mode, settings, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        results[mode] = best
+    return results
+
+
+def startup(repeat=10):
+    """Times, in milliseconds, a bare interpreter, importing redcap_repeat and running the script on a one
+    group dictionary, each in a fresh process. The fastest of `repeat` runs is kept."""
+    directory = os.path.dirname(os.path.abspath(redcap_repeat.__file__))
+    script = os.path.join(directory, "redcap_repeat.py")
+    handle, dictionary = tempfile.mkstemp(suffix=".csv")
+    handle = os.fdopen(handle, 'wb')
+    csv.writer(handle).writerows(generate_dictionary(rows=10, group_ratio=1))
+    handle.close()
+    commands = {
+        'interpreter': [sys.executable, "-c", "pass"],
+        'import': [sys.executable, "-c", "import redcap_repeat"],
+        'cli': [sys.executable, script, dictionary, os.devnull],
+    }
+    results = {}
+    try:
+        for name, command in commands.items():
+            best = None
+            for i in range(repeat):
+                started = time.time()
+                subprocess.check_call(command, cwd=directory)
+                elapsed = (time.time() - started) * 1000
+                if best is None or elapsed < best:
+                    best = elapsed
+            results[name] = best
+    finally:
+        os.remove(dictionary)
+    return results
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--rows", default=1000, dest="rows", type="int",
+            help="The number of input rows to generate.")
+    parser.add_option("-d", "--max_depth", default=1, dest="max_depth", type="int",
+            help="How deeply repeating groups nest.")
+    parser.add_option("-t", "--times", default=5, dest="times", type="int",
+            help="The number of times each group repeats.")
+    parser.add_option("--group_ratio", default=0.3, dest="group_ratio", type="float",
+            help="The chance that the next item is a repeating group (or a nested group inside one).")
+    parser.add_option("--group_size", default=4, dest="group_size", type="int",
+            help="The number of lines in each repeating group.")
+    parser.add_option("--other_id", default=0.2, dest="other_id", type="float",
+            help="The chance that a group repeats according to another field ([other_id]) instead of a fixed number.")
+    parser.add_option("--logic_density", default=0.3, dest="logic_density", type="float",
+            help="The chance that a field has branching logic.")
+    parser.add_option("--types", default=None, dest="types",
+            help="Comma separated field types to generate, including the custom types. Defaults to a mix of all of them.")
+    parser.add_option("--seed", default=1, dest="seed", type="int", help="The random seed.")
+    parser.add_option("-m", "--modes", default=",".join(modes), dest="modes",
+            help="Comma separated modes to run, from default, prompt and auto.")
+    parser.add_option("-n", "--repeat", default=3, dest="repeat", type="int",
+            help="Run each mode this many times and report the fastest.")
+    parser.add_option("-o", "--output", default=None, dest="output",
+            help="Save the results as JSON to this file.")
+    parser.add_option("-w", "--write_dictionary", default=None, dest="write_dictionary",
+            help="Write the generated dictionary to this file and exit, without benchmarking.")
+    parser.add_option("--startup", default=False, dest="startup", action="store_true",
+            help="Time the import of the module and a run of the script on a tiny dictionary in fresh processes instead.")
+    (options, args) = parser.parse_args()
+
+    settings = {
+        'rows': options.rows,
+        'max_depth': options.max_depth,
+        'times': options.times,
+        'group_ratio': options.group_ratio,
+        'group_size': options.group_size,
+        'other_id': options.other_id,
+        'logic_density': options.logic_density,
+        'types': options.types.split(",") if options.types else None,
+        'seed': options.seed,
+    }
+
+    if options.write_dictionary:
+        handle = open(options.write_dictionary, 'wb')
+        csv.writer(handle).writerows(generate_dictionary(**settings))
+        handle.close()
+        sys.exit()
+
+    if options.startup:
+        results = startup(max(options.repeat, 10))
+        for name in ('interpreter', 'import', 'cli'):
+            print "%-12s %7.1f ms  (%+.1f ms over the interpreter)" % (name, results[name], results[name] - results['interpreter'])
+        settings = {'startup': True}
+    else:
+        results = benchmark(settings, options.modes.split(","), options.repeat)
+        for mode in options.modes.split(","):
+            result = results[mode]
+            print "%-8s %7d -> %8d rows  %8.3fs  %10.0f rows/sec  %8d KB peak  (read %.3fs, preprocess %.3fs, expand %.3fs, write %.3fs)" % (
+                    mode, result['input_rows'], result['output_rows'], result['seconds'], result['output_rows_per_sec'] or 0,
+                    result['peak_memory_kb'], result['stages']['read'], result['stages']['preprocess'],
+                    result['stages']['expand'], result['stages']['write'])
+
+    if options.output:
+        report = {
+            'settings': settings,
+            'results': results,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        handle = open(options.output, 'w')
+        json.dump(report, handle, indent=2, sort_keys=True)
+        handle.close()
@@ -23,19 +23,40 @@ import os
 import csv
 import re
 import sys
-import copy
 import json
+import time
 import logging
+import itertools
 # New comment
 from optparse import OptionParser
-from collections import defaultdict
+from collections import defaultdict, Counter, deque
+from json.encoder import encode_basestring_ascii as encode_string
 from string import Template
 from functools import partial
-try:
-    import inflector
-    pluralize = inflector.English().pluralize
-except:
-    pluralize = lambda x : "%ss" % x
+
+# The inflector package is slow to import, so it is only loaded the first time a name is pluralized
+pluralizer = None
+have_inflector = None
+
+def load_pluralizer():
+    global pluralizer, have_inflector
+    if pluralizer is None:
+        try:
+            import inflector
+            pluralizer = inflector.English().pluralize
+            have_inflector = True
+        except:
+            pluralizer = lambda x : "%ss" % x
+            have_inflector = False
+    return pluralizer
+
+def pluralize(word):
+    return load_pluralizer()(word)
+
+
+class RepeatError(Exception):
+    """Raised when a data dictionary cannot be expanded. The message says which record is at fault."""
+    pass
 
 
 class FakeOptions:
@@ -43,21 +64,27 @@ class FakeOptions:
     prompt = True
     validation_off = True
     groups = False
-
-# Users can specify a file that maps group names to their correct pluralization
-plurals = {}
-if os.path.isfile("plurals.json"):
-    plurals_file = open("plurals.json")
+    max_repeat = 10
+    simplify_logic = False
+    plurals = None
+    group_jobs = None
+    max_fields = None
+    native = False
+
+def load_plurals(path):
+    """Reads a JSON file that maps lower case group names to their correct pluralization"""
     try:
-        plurals = json.load(plurals_file)
-    except:
-        pass
-    finally:
-        plurals_file.close()
+        plurals_file = open(path)
+        try:
+            return json.load(plurals_file)
+        finally:
+            plurals_file.close()
+    except (IOError, ValueError), e:
+        raise RepeatError("Error reading the plurals file %s: %s" % (path, e))
 
 logger = logging.getLogger("redcap_preproces")
 logger.addHandler(logging.StreamHandler())
-logger.setLevel(logging.ERROR)
+logger.setLevel(logging.WARNING)
 
 begin  =  re.compile(r'([a-zA-Z_0-9${}]+)? +(repeat|startrepeat) +([][a-z_0-9]*) +(\w.*)')
 end  = re.compile(r'([a-zA-Z_0-9${}]+)? +(endrepeat) *')
@@ -67,6 +94,10 @@ other_id_with_num_re = re.compile(r'\[([a-z_0-9]*)\](\d+)')
 
 paren_re = re.compile(r'([a-zA-Z0-9 ]*)(\([a-zA-Z0-9 ]*\))')
 
+# A field reference in branching logic, either [field] or [field(code)]. Only the opening bracket and
+# the name are consumed so splitting on it leaves the rest of the expression untouched
+field_ref_re = re.compile(r'\[([^][()]*)(?=[](])')
+
 key = {'a':0,'b':1,'c':2,'d':3,'e':4,'f':5,'g':6,'h':7,'i':8,'j':9,'k':10,'l':11,'m':12, 'p':15}
 number_map = {0:"th", 1:"st", 2:"nd", 3:"rd", 4:"th", 5:"th", 6:"th", 7:"th", 8:"th", 9:"th"}
 
@@ -80,54 +111,361 @@ def numberEnding(iteration):
     else:
         return number_map[iteration % 10]
 
-def extract(cell, regex):
-     match = regex.match(cell)
-     if match:
-         groups = match.groups()
-         return {
-            "match":True,
-            "id": groups[0], 
-            "meta":groups[1:], 
-         }
-     else:
-         return { "match": False }
-
-extract_begin = partial(extract, regex=begin)
-extract_end = partial(extract, regex=end)
+class Marker(object):
+    """What column A of a row says about repeating. start holds the groups of the begin match (id, "repeat" or
+    "startrepeat", count, group name) and end those of the end match (id, "endrepeat"), each None if the cell
+    doesn't match. kind is "plain", "repeat", "startrepeat" or "endrepeat", and id is the field name."""
+
+    __slots__ = ('id', 'kind', 'count', 'name', 'start', 'end', 'opens', 'closes', 'bare_end')
+
+    def __init__(self, cell):
+        startmatch = begin.match(cell)
+        endmatch = end.match(cell)
+        self.start = startmatch.groups() if startmatch else None
+        self.end = endmatch.groups() if endmatch else None
+        self.id = cell.split(" ")[0]
+        self.count = self.start[2] if self.start else None
+        self.name = self.start[3] if self.start else None
+        # A cell can match both, the endrepeat is what counts when a custom type splits the row
+        meta = self.end or self.start
+        self.kind = meta[1] if meta else "plain"
+        # A repeat row is a whole group on its own
+        self.opens = startmatch is not None
+        self.closes = endmatch is not None or (startmatch is not None and self.start[1] == "repeat")
+        # An endrepeat row with no field of its own
+        self.bare_end = endmatch is not None and endmatch.group(0) == " endrepeat"
+
+markers = {}
+
+def classify(cell):
+    """The Marker of a column A cell. Every stage asks about the same cells, so they are only matched once"""
+    marker = markers.get(cell)
+    if marker is None:
+        if len(markers) > 100000:
+            markers.clear()
+        marker = markers[cell] = Marker(cell)
+    return marker
+
+logic_tokens = {}
+
+def tokenize_logic(logic):
+    """Splits branching logic into literal text and referenced field names, alternating text, name, text...
+    so the names sit at the odd indexes. Logic strings repeat a lot, so the result is cached"""
+    tokens = logic_tokens.get(logic)
+    if tokens is None:
+        if len(logic_tokens) > 10000:
+            logic_tokens.clear()
+        tokens = logic_tokens[logic] = tuple(field_ref_re.split(logic))
+    return tokens
+
+
+class IdScope(object):
+    """The field renames visible at one level of group nesting. Each level only holds the names of its own group's
+    fields and looks anything else up in the level it is nested in, so there is nothing to copy when going a
+    level deeper and the memory used grows with the nesting depth, not with every field seen so far."""
+
+    __slots__ = ('ids', 'parent')
+
+    def __init__(self, parent=None):
+        self.ids = {}
+        self.parent = parent
+
+    def get(self, cell, default=None):
+        scope = self
+        while scope is not None:
+            name = scope.ids.get(cell)
+            if name is not None:
+                return name
+            scope = scope.parent
+        return default
+
+    def __getitem__(self, cell):
+        name = self.get(cell)
+        if name is None:
+            raise KeyError(cell)
+        return name
+
+    def __setitem__(self, cell, name):
+        self.ids[cell] = name
+
+    def __contains__(self, cell):
+        return self.get(cell) is not None
+
+
+def rewrite_logic(logic, ids):
+    """Renames every field referenced in the logic that has an entry in ids, with one lookup per reference"""
+    if ids is None:
+        return logic
+    tokens = tokenize_logic(logic)
+    if len(tokens) == 1:
+        return logic
+    parts = list(tokens)
+    for index in range(1, len(parts), 2):
+        parts[index] = "[" + ids.get(parts[index], parts[index])
+    return "".join(parts)
+
+# Branching logic split into string literals, field references, parentheses and the boolean operators
+logic_split_re = re.compile(r"""('[^']*'|"[^"]*"|\[[^]]*\]|[()]|\band\b|\bor\b)""", re.I)
+# A field compared against a number, e.g. [n]>=3
+bound_re = re.compile(r'^\[([^][()]+)\]\s*(>=|<=|>|<)\s*(-?\d+(?:\.\d+)?)$')
+
+class LogicParser(object):
+    """Parses branching logic into nested ('and', [...]), ('or', [...]) and ('atom', text) tuples. Anything
+    between the boolean operators, function calls included, is kept as an atom. Returns None for logic it
+    can't make sense of."""
+
+    def __init__(self, logic):
+        self.tokens = [token for token in logic_split_re.split(logic) if token]
+        self.position = 0
+
+    def parse(self):
+        try:
+            node = self.expression()
+        except ValueError:
+            return None
+        if self.peek() is not None:
+            return None
+        return node
+
+    def peek(self):
+        # Skips whitespace between tokens
+        while self.position < len(self.tokens) and self.tokens[self.position].isspace():
+            self.position += 1
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def operator(self):
+        token = self.peek()
+        if token is not None and token.lower() in ("and", "or"):
+            return token.lower()
+        return None
+
+    def expression(self):
+        # "and" binds tighter than "or", as it does when REDCap evaluates the logic
+        terms = [self.conjunction()]
+        while self.operator() == "or":
+            self.position += 1
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else ("or", terms)
+
+    def conjunction(self):
+        terms = [self.primary()]
+        while self.operator() == "and":
+            self.position += 1
+            terms.append(self.primary())
+        return terms[0] if len(terms) == 1 else ("and", terms)
+
+    def primary(self):
+        if self.peek() == "(":
+            self.position += 1
+            node = self.expression()
+            if self.peek() != ")":
+                raise ValueError("unbalanced parentheses")
+            self.position += 1
+            return node
+        return self.atom()
+
+    def atom(self):
+        parts = []
+        depth = 0
+        while self.position < len(self.tokens):
+            token = self.tokens[self.position]
+            if depth == 0:
+                if token == ")" or (token.lower() in ("and", "or")):
+                    break
+                if token == "(" and not "".join(parts).strip():
+                    # A bracketed comparison like ([a]+1)>2 that doesn't fit the grammar
+                    raise ValueError("unexpected parenthesis")
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+            parts.append(token)
+            self.position += 1
+        text = "".join(parts).strip()
+        if depth or not text:
+            raise ValueError("malformed comparison")
+        return ("atom", text)
+
+def format_logic(node, parent=None):
+    """Turns a parsed expression back into logic, only adding the parentheses that are needed"""
+    if node[0] == "atom":
+        return node[1]
+    text = (" %s " % node[0]).join([format_logic(term, node[0]) for term in node[1]])
+    # "and" binds tighter than "or", so only a disjunction within a conjunction needs them
+    if parent == "and" and node[0] == "or":
+        return "(%s)" % text
+    return text
+
+def logic_bound(node):
+    """Returns (field, lower, value, strict) for a field compared against a number, None otherwise"""
+    if node[0] != "atom":
+        return None
+    match = bound_re.match(node[1])
+    if match is None:
+        return None
+    field, operator, value = match.groups()
+    return field, operator[0] == ">", float(value), len(operator) == 1
+
+def bound_implies(a, b):
+    """Whether the comparison a being true means b is true as well"""
+    if a[:2] != b[:2]:
+        return False
+    if a[2] == b[2]:
+        return a[3] or not b[3]
+    return a[2] > b[2] if a[1] else a[2] < b[2]
+
+def simplify_node(node):
+    if node[0] == "atom":
+        return node
+    operator = node[0]
+    terms = []
+    seen = set()
+    for term in node[1]:
+        term = simplify_node(term)
+        # (a and b) and c is a and b and c
+        for term in (term[1] if term[0] == operator else [term]):
+            text = format_logic(term)
+            if text not in seen:
+                seen.add(text)
+                terms.append(term)
+
+    # In a conjunction [n]>=3 makes [n]>=2 redundant, in a disjunction [n]>=2 makes [n]>=3 redundant
+    bounds = [logic_bound(term) for term in terms]
+    kept = []
+    for index, term in enumerate(terms):
+        bound = bounds[index]
+        if bound is not None:
+            others = [other for position, other in enumerate(bounds)
+                    if other is not None and position != index and (position in kept or position > index)]
+            if operator == "and" and any(bound_implies(other, bound) for other in others):
+                continue
+            if operator == "or" and any(bound_implies(bound, other) for other in others):
+                continue
+        kept.append(index)
+    terms = [terms[index] for index in kept]
+    return terms[0] if len(terms) == 1 else (operator, terms)
+
+def simplify_logic(logic):
+    """Shortens generated branching logic by dropping redundant parentheses, repeated conditions and
+    comparisons made redundant by another one next to them. Logic that can't be parsed is returned as is."""
+    if not logic.strip():
+        return logic
+    node = LogicParser(logic).parse()
+    if node is None:
+        return logic
+    return format_logic(simplify_node(node))
+
+class TemplateCache(object):
+    """A bounded cache of string.Template objects keyed by their source string. The same prompts, field
+    names and section headers are substituted over and over, so they are only parsed once."""
+
+    def __init__(self, size=2048):
+        self.size = size
+        self.templates = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source):
+        template = self.templates.get(source)
+        if template is None:
+            self.misses += 1
+            if len(self.templates) >= self.size:
+                self.templates.clear()
+            template = self.templates[source] = Template(source)
+        else:
+            self.hits += 1
+        return template
+
+    def substitute(self, source, **mapping):
+        return self.get(source).safe_substitute(**mapping)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+# For the labels of the custom types. Each Expander has its own for the groups it expands.
+templates = TemplateCache()
+
+class Choices(object):
+    """The parsed choices of a field, e.g. "1, Yes | 2, No". codes, labels and normalized (lower case) labels
+    are in the order given. labels is None if an entry has no comma, numbers is None unless every code is an
+    integer."""
+
+    def __init__(self, source):
+        self.codes = []
+        self.labels = []
+        self.normalized = []
+        for entry in source.split("|"):
+            parts = entry.split(",", 1)
+            self.codes.append(parts[0].strip())
+            if self.labels is not None:
+                if len(parts) < 2:
+                    self.labels = self.normalized = None
+                else:
+                    self.labels.append(parts[1].strip())
+                    self.normalized.append(self.labels[-1].lower())
+        self.code_set = set(self.codes)
+        try:
+            self.numbers = [int(code) for code in self.codes]
+        except ValueError:
+            self.numbers = None
+
+choice_index = {}
+
+def parse_choices(source):
+    """The Choices for a choice string. The same choice lists are used by many fields, so they are cached"""
+    choices = choice_index.get(source)
+    if choices is None:
+        if len(choice_index) > 10000:
+            choice_index.clear()
+        choices = choice_index[source] = Choices(source)
+    return choices
+
+cleaned = {}
 
 def clean(x):
-    return x.replace(" ","_").replace("/","_").replace("(","_").replace(")","_").lower()
+    name = cleaned.get(x)
+    if name is None:
+        if len(cleaned) > 100000:
+            cleaned.clear()
+        name = cleaned[x] = x.replace(" ","_").replace("/","_").replace("(","_").replace(")","_").lower()
+    return name
+
+preserved = {}
 
 def preserve_metadata(position, extension, cell):
-    meta = None 
-    meta1 = extract_begin(cell)
-    meta2 = extract_end(cell)
-    if meta1['match']:
-        meta = meta1
-    if meta2['match']:
-        meta = meta2
-    
-    if not meta or not meta['match'] or position not in {'begin':1, 'end':1}:
-        return "%s%s" % (cell.split(" ")[0], extension)
-    
-    new_cell = cell
-    if meta['match'] and meta['meta'][0] == "repeat":
+    new_cell = preserved.get((position, extension, cell))
+    if new_cell is None:
+        if len(preserved) > 100000:
+            preserved.clear()
+        new_cell = preserved[(position, extension, cell)] = move_metadata(position, extension, classify(cell))
+    return new_cell
+
+def move_metadata(position, extension, marker):
+    """The name of the field a custom type generates at position (begin, middle or end) of the ones it splits
+    the row into, keeping the row's repeat markers on the first and last"""
+    meta = marker.end or marker.start
+    if not meta or position not in {'begin':1, 'end':1}:
+        return "%s%s" % (marker.id, extension)
+
+    if meta[1] == "repeat":
         # if it was a minimum field marked as repeat, we need to map it to a startrepeat end repeat
         if position == "begin":
-            new_cell =  "%s%s %s" % (meta["id"], extension, "startrepeat %s %s" % meta['meta'][1:])
+            new_cell =  "%s%s %s" % (meta[0], extension, "startrepeat %s %s" % meta[2:])
         else:
-            new_cell = "%s%s %s" % (meta["id"], extension, "endrepeat")
-    elif meta['match'] and meta['meta'][0] == "startrepeat":
+            new_cell = "%s%s %s" % (meta[0], extension, "endrepeat")
+    elif meta[1] == "startrepeat":
         if position == "begin":
-            new_cell = "%s%s %s" % (meta["id"], extension, "startrepeat %s %s" % meta['meta'][1:])
+            new_cell = "%s%s %s" % (meta[0], extension, "startrepeat %s %s" % meta[2:])
         else:
-            new_cell = "%s%s" % (meta["id"], extension)
-    elif meta['match'] and meta['meta'][0] == "endrepeat":
+            new_cell = "%s%s" % (meta[0], extension)
+    else:
         if position == "begin":
-            new_cell= "%s%s" % (meta["id"], extension)
+            new_cell= "%s%s" % (meta[0], extension)
         else:
-            new_cell = "%s%s %s" % (meta["id"], extension, "endrepeat")
-
+            new_cell = "%s%s %s" % (meta[0], extension, "endrepeat")
 
     return new_cell
 
@@ -144,29 +482,25 @@ def minmax(line, minimum="minimum", maximum="maximum"):
     min_line[key['d']] = "text"
     max_line[key['d']] = "text"
 
-    min_line[key['e']] = Template(min_line[key['e']]).safe_substitute(placeholder=minimum)
-    max_line[key['e']] = Template(max_line[key['e']]).safe_substitute(placeholder=maximum)
+    min_line[key['e']] = templates.substitute(min_line[key['e']], placeholder=minimum)
+    max_line[key['e']] = templates.substitute(max_line[key['e']], placeholder=maximum)
     return [min_line, max_line]
 
 def details(line, kind = "checkbox", detail_kind = "text", details = None ):
-    choices = line[key['f']].split("|")
-    choices = [x.split(",", 1) for x in choices]
-    try:
-        choices = [(x[0].strip(), x[1].strip()) for x in choices]
-    except IndexError:
-        sys.stderr.write("Error processing record %s, please check that the field choices all have a comma"
-            " between the number and the choice.\n" % line[key['a']])
-        sys.exit()
+    choices = parse_choices(line[key['f']])
+    if choices.labels is None:
+        raise RepeatError("Error processing record %s, please check that the field choices all have a comma"
+            " between the number and the choice." % line[key['a']])
      
     if details == False:
         s = line[key['a']]
         par = s.find("'")
         par2 = s.find("'", par+1)
         details = [s[par+1:par2].lower()]
-        print(details)
         
     if details == None:
-        details = [x[1].lower() for x in choices]
+        details = choices.normalized
+    wanted = set(details)
 
     description = line[key['e']].split(" | ")
     new_line = line[:]
@@ -177,15 +511,15 @@ def details(line, kind = "checkbox", detail_kind = "text", details = None ):
     new_lines = [new_line]
 
     last_detail = None
-    for index, choice in choices:
-       if choice.lower() in details:
+    for index, choice, normalized in zip(choices.codes, choices.labels, choices.normalized):
+       if normalized in wanted:
            # if its an other field default to a better wording
            if len(details) == 1 and details[0] == "other":
                prompt = "Please specify other %s" % description[0]
            else:
                prompt = "Please specify details for %s" % choice
            if len(description) > 1:
-                 prompt = Template(description[1]).safe_substitute(placeholder = choice)
+                 prompt = templates.substitute(description[1], placeholder = choice)
            other_line = line[:]
            other_line[key['a']] = preserve_metadata("middle", "_%s_dtls" % clean(choice), line[key['a']])
            other_line[key['d']] = detail_kind
@@ -200,25 +534,26 @@ def details(line, kind = "checkbox", detail_kind = "text", details = None ):
            other_line[key['c']] = ""
            new_lines.append(other_line)
     if last_detail == None:
-        sys.stderr.write("Error: For record '%s', since the datatype is of type '*_other' you must specify an 'other'"
-                " choice, chosen from one of the following values: %s \n" % (line[key['a']], details))
-        sys.exit()
+        raise RepeatError("Error: For record '%s', since the datatype is of type '*_other' you must specify an 'other'"
+                " choice, chosen from one of the following values: %s" % (line[key['a']], details))
     # Go back and fix the last one
     new_lines[-1][key['a']] = preserve_metadata("end", "_%s_dtls" % clean(last_detail), line[key['a']])
 
     return new_lines
 
+mutexes = set(['none', 'unknown', 'result not known', 'unknown/not documented', 'unknown or not reported'])
+
 def checkbox_mutex_other (line, kind = "checkbox", detail_kind = "descriptive", details = None, other = False):
-    #create a list of choices by splitting all the options at the "|" character
-    choices = line[key['f']].split("|")
-    choices = [x.split(",", 1) for x in choices]
-    size = len(choices)
-    indexes = [];
-    for x in choices:
-        y = x
-        indexes.append(int(y[0]))
-    #convert all the choices to lower case and then create a list with all the options selected by the user
-    details = [x[1].lower() for x in choices]
+    choices = parse_choices(line[key['f']])
+    if choices.labels is None:
+        raise RepeatError("Error processing record %s, please check that the field choices all have a comma"
+            " between the number and the choice." % line[key['a']])
+    field = line[key['a']].split(" ")[0]
+    # Every option is tested against all the others, in numeric order when the codes are numbers
+    if choices.numbers is not None:
+        ordered = sorted(choices.numbers)
+    else:
+        ordered = choices.codes
     description = line[key['e']].split(" | ")
     new_line = line[:]
     last = ""
@@ -227,47 +562,25 @@ def checkbox_mutex_other (line, kind = "checkbox", detail_kind = "descriptive",
     new_line[key['d']] = kind
     in_options = False
     new_lines = [new_line]
-    mutexes = ['none', 'unknown', 'result not known', 'unknown/not documented', 'unknown or not reported']
-    for index, choice in choices:
-        x = choice.lower()
-        x = x.lstrip('  ')
-        x = x.rstrip('  ')
-        index = index.lstrip(' ')
-        #create list of all possible none/unknown options
-        #check for the existence of each one in the list of choices
-        for mutex in mutexes:
-            if x == mutex:
-                in_options = True
-                prompt = "You selected %s and another answer choice. Please revise your answer." % mutex
+    for position, index in enumerate(choices.codes):
+        x = choices.normalized[position]
+        #check for the existence of each none/unknown option in the list of choices
+        if x in mutexes:
+            in_options = True
+            this = choices.numbers[position] if choices.numbers is not None else index
+            others = ["[%s(%s)] = '1'" % (field, code) for code in ordered if code != this]
+            if others:
+                prompt = "You selected %s and another answer choice. Please revise your answer." % x
                 other_line = line[:]
                 last = "_%s" % clean(x)
                 other_line[key['a']] = preserve_metadata("middle", last , line[key['a']])
                 other_line[key['d']] = detail_kind
                 other_line[key['f']] = ""
                 other_line[key['e']] = prompt
-                #deal with the instance if there is only two options
-                if size <= 2 and index == 1:
-                    other_line[key['l']] = "[%s(%s)]='1' and [%s(%s)] = '1'" % (line[key['a']].split(" ")[0], index, line[key['a']].split(" ")[0], int(index) + 1)
-                elif size <= 2 and index == 2:
-                    other_line[key['l']] = "[%s(%s)]='1' and [%s(%s)] = '1'" % (line[key['a']].split(" ")[0], index, line[key['a']].split(" ")[0], int(index) - 1)
-                #more than two options
+                if len(others) == 1:
+                    other_line[key['l']] = "[%s(%s)]='1' and %s" % (field, index, others[0])
                 else:
-                    branching_string = "[%s(%s)]='1' and ([%s(%s)] = '1' or "
-                    string_add = "[%s(%s)] = '1' or "
-                    string_final = "[%s(%s)] = '1')"
-                    branching_final = branching_string+(size-3)*string_add+string_final
-                    sub_list = (line[key['a']].split(" ")[0], index)
-                    for r in range(1,int(index)):
-                        if r not in indexes:
-                            continue
-                        else:
-                            sub_list = sub_list + (line[key['a']].split(" ")[0], r)
-                    for r in range(int(index) + 1, size + 3):
-                        if r not in indexes:
-                            continue
-                        else:
-                            sub_list = sub_list + (line[key['a']].split(" ")[0], r)
-                    other_line[key['l']] = branching_final % sub_list
+                    other_line[key['l']] = "[%s(%s)]='1' and (%s)" % (field, index, " or ".join(others))
                 other_line[key['c']] = ""
                 new_lines.append(other_line)
 
@@ -278,18 +591,17 @@ def checkbox_mutex_other (line, kind = "checkbox", detail_kind = "descriptive",
             other_line[key['d']] = "notes"
             other_line[key['f']] = ""
             if len(description) > 1:
-                prompt = Template(description[1]).safe_substitute(placeholder = x)
+                prompt = templates.substitute(description[1], placeholder = x)
             else :
                 prompt = "Please specify other %s" % description[0];
 
             other_line[key['e']] = prompt
-            other_line[key['l']] = "[%s(%s)]='1'" % (line[key['a']].split(" ")[0], index)
+            other_line[key['l']] = "[%s(%s)]='1'" % (field, index)
             other_line[key['c']] = ""
             new_lines.append(other_line)
     if in_options == False:
-        sys.stderr.write("Error processing record %s, please check that a mutex field ('none', 'unknown', 'result not known',"
-            "'unknown/not documented', 'unknown or not reported') exists in the options for the question.\n" % line[key['a']])
-        sys.exit()
+        raise RepeatError("Error processing record %s, please check that a mutex field ('none', 'unknown', 'result not known',"
+            "'unknown/not documented', 'unknown or not reported') exists in the options for the question." % line[key['a']])
 
     new_lines[-1][key['a']] = preserve_metadata("end", last, line[key['a']])
     return new_lines
@@ -310,7 +622,7 @@ def value_units(line, kind = "dropdown", units = [], just_units = False):
         value_line[key['a']] = preserve_metadata("end", "", value_line[key['a']])
     else:
         value_line[key['a']] = preserve_metadata("middle", "", value_line[key['a']])
-        oz_line[key['a']] =  preserve_metadata("end", "_oz", value_line[key['a']])
+        oz_line[key['a']] =  preserve_metadata("end", "_oz", oz_line[key['a']])
 
     units_line[key['d']] = kind
     value_line[key['d']] = "text"
@@ -319,9 +631,9 @@ def value_units(line, kind = "dropdown", units = [], just_units = False):
     units_line[key['h']] = ""
     oz_line[key['h']] = ""
 
-    value_line[key['e']] = Template(value_line[key['e']]).safe_substitute(placeholder="").strip()
-    units_line[key['e']] = Template(units_line[key['e']]).safe_substitute(placeholder="").strip()
-    oz_line[key['e']] = Template(oz_line[key['e']]).safe_substitute(placeholder="").strip()
+    value_line[key['e']] = templates.substitute(value_line[key['e']], placeholder="").strip()
+    units_line[key['e']] = templates.substitute(units_line[key['e']], placeholder="").strip()
+    oz_line[key['e']] = templates.substitute(oz_line[key['e']], placeholder="").strip()
 
     units_line[key['e']] = "%s units" % units_line[key['e']]
     oz_line[key['e']] = "%s ounces" % oz_line[key['e']]
@@ -358,11 +670,11 @@ def age_weeks_days(line):
     weeks_line[key['h']] = "integer"
     days_line[key['h']] = "integer"
 
-    weeks_line[key['i']] = 0
-    weeks_line[key['j']] = 52
+    weeks_line[key['i']] = "0"
+    weeks_line[key['j']] = "52"
 
-    days_line[key['i']] = 0
-    days_line[key['j']] = 6
+    days_line[key['i']] = "0"
+    days_line[key['j']] = "6"
 
     weeks_line[key['e']] = "%s in full weeks" % weeks_line[key['e']]
     days_line[key['e']] = "%s in days (partial week)" % days_line[key['e']]
@@ -387,11 +699,11 @@ def age_years_months(line):
     years_line[key['h']] = "integer"
     months_line[key['h']] = "integer"
 
-    years_line[key['i']] = 0
-    years_line[key['j']] = 100 
+    years_line[key['i']] = "0"
+    years_line[key['j']] = "100"
 
-    months_line[key['i']] = 0
-    months_line[key['j']] = 11
+    months_line[key['i']] = "0"
+    months_line[key['j']] = "11"
 
     years_line[key['e']] = "%s in full years" % years_line[key['e']]
     months_line[key['e']] = "%s additional months (partial year)" % months_line[key['e']]
@@ -460,314 +772,1983 @@ dispatch['checkbox_mutex_other'] = partial(checkbox_mutex_other, other = True)
 dispatch['details_specify'] = partial(details, details = False)
 
 
-def repeat_group(group, path=[], ids={}, depth=0, iterations=[], parent_group=[], branch="", pre_logic=""):
-    depth += 1
-    first = group[0]
-    last = group[-1]
+def plural_group_name(name, plurals):
+    """The pluralized form of a group name used in generated questions and section headers"""
+    plural_name = name
+    plural_match = paren_re.match(plural_name)
 
-    if first != last:
-    # Last could be a single row that just matched " endrepeat", if so, throw it out
-        match = end.match(last[key['a']])
-        if match and match.group(0) == " endrepeat":
-            group = group[:-1]
-            last = group[-1]
-    new_rows = []
-    show_instance = None
-    match = begin.match(first[key['a']])
-    # This parameter can be a few things
-    # 1) A number, which indicates this is a variably repeating group
-    # 2) [Another ID] which indicates this group will repeat a number of times based on the value of another entry
-    #    This will search for this value and try to use its upper bound value for the maximum number of fields
-    #    If it cannot find it, it will use the default from the options object, which is 10
-    # 3) [Another ID]10 which indicates the same as above, but with a specified maximum
-    try:
-        times = int(match.group(3))
-    except ValueError:
-        other_id_match = other_id_re.match(match.group(3))
-        other_id_max_match = other_id_with_num_re.match(match.group(3))
-        if other_id_match:
-            for line in parent_group:
-                if line[key['a']].split(" ")[0] == other_id_match.group(1):
-                    if line[key['j']].isdigit():
-                        times = int(line[key['j']])
-                        break
+    if plurals.has_key(name.lower()):
+         plural_name = plurals[name.lower()]
+    elif plural_match:
+        plural_name = plural_match.group(1).strip()
+        plural_name = plural_name.lower() if not plural_name.isupper() else plural_name
+        plural_name = pluralize(plural_name)
+        plural_name = plural_name + " " + plural_match.group(2)
+    else:
+         plural_name = plural_name.lower() if not plural_name.isupper() else plural_name
+         plural_name = pluralize(plural_name)
+    return plural_name
+
+
+class ExpandedRow(object):
+    """A generated row of a repeating group. Only the field name, label, branching logic and matrix group
+    name change from one iteration to the next, so those are all it stores; every other cell is read from
+    the line's skeleton, which all iterations share. It behaves like a (read only) list of cells and is
+    turned into a real one with to_list() when it is written."""
+
+    __slots__ = ('skeleton', 'name', 'label', 'logic', 'matrix')
+
+    def __init__(self, skeleton, name, label, logic, matrix=None):
+        self.skeleton = skeleton
+        self.name = name
+        self.label = label
+        self.logic = logic
+        self.matrix = matrix
+
+    def to_list(self):
+        row = self.skeleton[:]
+        row[key['a']] = self.name
+        row[key['e']] = self.label
+        row[key['l']] = self.logic
+        if self.matrix is not None:
+            row[key['p']] = self.matrix
+        return row
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        if index < 0:
+            index += len(self.skeleton)
+        if index == key['a']:
+            return self.name
+        if index == key['l']:
+            return self.logic
+        if index == key['e']:
+            return self.label
+        if index == key['p'] and self.matrix is not None:
+            return self.matrix
+        return self.skeleton[index]
+
+    def __len__(self):
+        return len(self.skeleton)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __eq__(self, other):
+        if isinstance(other, ExpandedRow):
+            other = other.to_list()
+        elif not isinstance(other, (list, tuple)):
+            return NotImplemented
+        return self.to_list() == list(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+    def __reduce__(self):
+        # Pickled as its constructor arguments, so the skeleton is sent once for all the rows that share it
+        return ExpandedRow, (self.skeleton, self.name, self.label, self.logic, self.matrix)
+
+
+def as_list(row):
+    """A row as a list of its own, whether it is one already or an ExpandedRow"""
+    return row if type(row) is list else row.to_list()
+
+
+class LinePlan(object):
+    """A single (non group) line of a repeating group with everything that does not depend on the iteration
+    worked out up front. The skeleton is copied for every iteration and only the field name, prompt, logic and
+    matrix group name are filled in."""
+
+    def __init__(self, line, name_pattern, options, templates):
+        skeleton = line[:]
+        # Section headers are never repeated
+        skeleton[key['c']] = ""
+        if options.validation_off:
+            skeleton[key['h']] = skeleton[key['i']] = skeleton[key['j']] = ''
+        self.skeleton = skeleton
+
+        self.cell = classify(line[key['a']]).id
+        self.cell_template = templates.get(self.cell) if "${d}" in self.cell else None
+
+        self.prompt = line[key['e']]
+        self.prompt_template = templates.get(self.prompt) if "$" in self.prompt else None
+        # Pieces of the prompt around the group name, used when the prompt has no $d/$s of its own
+        self.name_split = name_pattern.split(self.prompt) if name_pattern.search(self.prompt) else None
+
+        self.logic = line[key['l']]
+        self.has_logic = len(self.logic.strip()) > 0
+
+        # Support for matrix group name
+        self.matrix = None
+        if (len(line) - 1) >= key['p'] and line[key['p']].strip():
+            self.matrix = line[key['p']]
+
+
+class FieldBounds(object):
+    """The maximum (column j) of each field by name, for groups that repeat [other_id] times. Only the first
+    row of a name that has a numeric maximum counts, as that is where the count question is."""
+
+    def __init__(self, rows=()):
+        self.bounds = {}
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        if len(row) > key['j'] and row[key['j']].isdigit():
+            name = row[key['a']].split(" ")[0]
+            if name not in self.bounds:
+                self.bounds[name] = int(row[key['j']])
+
+    def get(self, name):
+        return self.bounds.get(name)
+
+    def subset(self, name):
+        """A FieldBounds holding just the named field, if it is known"""
+        bounds = FieldBounds()
+        if name in self.bounds:
+            bounds.bounds[name] = self.bounds[name]
+        return bounds
+
+
+class GroupPlan(object):
+    """A repeating group parsed once into its lines and nested groups. Expanding the plan for each
+    iteration reuses everything here instead of re-parsing the group."""
+
+    def __init__(self, group, expander, parent_bounds=None, stats=None):
+        self.options = expander.options
+        self.expander = expander
+        first = group[0]
+        last = group[-1]
+
+        if first != last:
+        # Last could be a single row that just matched " endrepeat", if so, throw it out
+            if classify(last[key['a']]).bare_end:
+                group = group[:-1]
+        self.group = group
+        self.first = first
+
+        marker = classify(first[key['a']])
+        self.count = marker.count
+        self.name = marker.name
+        self.clean_name = clean(self.name)
+        self.name_pattern = re.compile(re.escape(self.name), re.IGNORECASE)
+        # The section header of a nested group has already been blanked by its parent
+        self.header = first[key['c']] if parent_bounds is None else ""
+
+        # All the field names of the group (nested ones included) that logic could refer to
+        self.cells = [classify(line[key['a']]).id for line in group]
+        self.cell_templates = [expander.templates.get(cell) if "${d}" in cell else None for cell in self.cells]
+
+        # Parents are recorded before the groups nested in them
+        self.record = None
+        if stats is not None:
+            self.record = stats.add_group(first[key['a']], len(group))
+
+        self.items = []
+        # Nested groups look up their repeat count among the rows of this group
+        bounds = None
+        index = 0
+        while index < len(group):
+            line = group[index]
+            if index >= 1 and classify(line[key['a']]).opens:
+                # found a nested group
+                nested_group = find_group(group, index)
+                logger.debug("Found nested Group %s - length %d" % (line[key['a']], len(nested_group)))
+                logger.debug("Last member is %s" % nested_group[-1][key['a']])
+                if bounds is None:
+                    bounds = FieldBounds(group)
+                self.items.append(GroupPlan(nested_group, expander, bounds, stats))
+                # The lines in the nested group are not processed as part of this group
+                index += len(nested_group)
             else:
-                times = options.max_repeat
-            show_instance = other_id_match.group(1)
-        elif other_id_max_match:
-            times = int(other_id_max_match.group(2))
-            show_instance = other_id_max_match.group(1)
-        else:
-            logger.error("Error on following line: %s" % first)
-            sys.exit()
-
-    name = match.group(4)
-    prefix = "_".join(path)
-    if len(prefix):
-        prefix = prefix + "_"
-    clean_name = clean(name)
-    name_pattern = re.compile(re.escape(name), re.IGNORECASE)
-    another_branch = branch
-    
-    # If in the default mode, which asks prompts the user up front for the number of items in each repeating group, add that question here
-    # If show_instance is already defined, then it means this group repeats a number determined by a previous question's value
-    if not (options.auto or options.prompt) and not show_instance:
-        number_line = template[:]
-        number_line[key['a']] = show_instance = "%s%s_%s" % (prefix, re.sub(' ','_', clean_name ), "group_no")
-        number_line[key['b']] = first[key['b']]
-        number_line[key['d']] = "text"
-        if not options.groups:
-            plural_name = name
-            plural_match = paren_re.match(plural_name)
-            
-            if plurals.has_key(name.lower()):
-                 plural_name = plurals[name.lower()]
-            elif plural_match:
-                plural_name = plural_match.group(1).strip()
-                plural_name = plural_name.lower() if not plural_name.isupper() else plural_name
-                plural_name = pluralize(plural_name)
-                plural_name = plural_name + " " + plural_match.group(2)
+                self.items.append(LinePlan(line, self.name_pattern, self.options, expander.templates))
+                index += 1
+
+        # What the auto scheme tests to decide whether to show the next iteration
+        self.first_cell = marker.id
+        self.first_cell_template = expander.templates.get(self.first_cell) if "${d}" in self.first_cell else None
+        self.first_is_checkbox = first[key['d']] == "checkbox"
+        if self.first_is_checkbox:
+            self.first_choices = parse_choices(first[key['f']]).codes
+
+        # A nested group always looks up its repeat count in the same parent, so only do it once
+        self.resolved = None
+        if parent_bounds is not None:
+            self.resolved = self.resolve_times(parent_bounds)
+
+    def resolve_times(self, parent_bounds):
+        """Returns the number of times the group repeats and, if that number comes from another field, its name"""
+        # This parameter can be a few things
+        # 1) A number, which indicates this is a variably repeating group
+        # 2) [Another ID] which indicates this group will repeat a number of times based on the value of another entry
+        #    This will search for this value and try to use its upper bound value for the maximum number of fields
+        #    If it cannot find it, it will use the default from the options object, which is 10
+        # 3) [Another ID]10 which indicates the same as above, but with a specified maximum
+        show_instance = None
+        try:
+            times = int(self.count)
+        except ValueError:
+            other_id_match = other_id_re.match(self.count)
+            other_id_max_match = other_id_with_num_re.match(self.count)
+            if other_id_match:
+                times = parent_bounds.get(other_id_match.group(1))
+                if times is None:
+                    times = self.options.max_repeat
+                show_instance = other_id_match.group(1)
+            elif other_id_max_match:
+                times = int(other_id_max_match.group(2))
+                show_instance = other_id_max_match.group(1)
             else:
-                 plural_name = plural_name.lower() if not plural_name.isupper() else plural_name
-                 plural_name = pluralize(plural_name)
-            
-            number_line[key['e']] = "How many %s would you like to enter (up to %d)?" % (plural_name, times)
-            number_line[key['c']] = Template(first[key['c']]).safe_substitute(placeholder = plural_name)
+                raise RepeatError("Error on following line: %s" % self.first)
+        return times, show_instance
+
+    def size(self, parent_bounds):
+        """Works out how many rows the group expands to on each form from its structure alone, without
+        expanding it. Returns a Counter of form name to rows."""
+        times, show_instance = self.resolved or self.resolve_times(parent_bounds)
+        options = self.options
+        per_iteration = Counter()
+        last_form = None
+        for item in self.items:
+            if isinstance(item, GroupPlan):
+                per_iteration.update(item.size(None))
+            else:
+                last_form = item.skeleton[key['b']]
+                per_iteration[last_form] += 1
+
+        forms = Counter()
+        for form, rows in per_iteration.items():
+            forms[form] += rows * times
+        # The count question
+        if not (options.auto or options.prompt) and not show_instance:
+            forms[self.first[key['b']]] += 1
+        # The "add another" checkbox between iterations, which is a copy of the last line
+        if options.prompt and not show_instance and times > 1:
+            forms[last_form] += times - 1
+        return forms
+
+    def units(self, parent_bounds):
+        """How the rows the group expands to can be shared out between forms: a 1 for the count question, then
+        a list for each iteration. Within an iteration a number stands for that many of the group's own rows in
+        a row, and a list for a nested group, split the same way."""
+        times, show_instance = self.resolved or self.resolve_times(parent_bounds)
+        options = self.options
+        units = []
+        if not (options.auto or options.prompt) and not show_instance:
+            units.append(1)
+
+        per_iteration = []
+        run = 0
+        for item in self.items:
+            if isinstance(item, GroupPlan):
+                if run:
+                    per_iteration.append(run)
+                    run = 0
+                per_iteration.append(item.units(None))
+            else:
+                run += 1
+        for iteration in range(1, times+1):
+            # The "add another" checkbox is a copy of the iteration's last line
+            last = run + (1 if options.prompt and iteration < times and not show_instance else 0)
+            units.append(per_iteration + [last] if last else per_iteration)
+        return units
+
+    def lineage(self, path, groups, iterations, parent_bounds):
+        """Yields (field name, source field, form, kind, group path, iterations) for every field the group
+        expands to, in the order they are generated. kind is "field" for the group's own fields, "count" for
+        the question asking how many to enter and "add_another" for the checkboxes of the -p scheme. The
+        group path holds the clean names of the groups from the outermost in, iterations the iteration of
+        each."""
+        times, show_instance = self.resolved or self.resolve_times(parent_bounds)
+        options = self.options
+        prefix = "_".join(path)
+        if len(prefix):
+            prefix = prefix + "_"
+        groups = groups + (self.clean_name,)
+
+        if not (options.auto or options.prompt) and not show_instance:
+            yield ("%s%s_%s" % (prefix, re.sub(' ','_', self.clean_name), "group_no"), "", self.first[key['b']],
+                    "count", groups, tuple(iterations))
+
+        for iteration in range(1, times+1):
+            numbered = tuple(iterations) + (iteration,)
+            form = None
+            for item in self.items:
+                if isinstance(item, GroupPlan):
+                    new_path = path + ["%s%d" % (self.clean_name, iteration)]
+                    for field in item.lineage(new_path, groups, numbered, None):
+                        yield field
+                    continue
+                form = item.skeleton[key['b']]
+                yield (self.cell_name(prefix, item.cell, item.cell_template, iteration), item.cell.replace("${d}", ""),
+                        form, "field", groups, numbered)
+            if options.prompt and iteration < times and not show_instance:
+                yield ("%s%s_repeat%s" % (prefix, self.clean_name, iteration), "", form, "add_another", groups, numbered)
+
+    def references(self):
+        """The names of the fields the branching logic of the group refers to"""
+        names = set()
+        for line in self.group:
+            if len(line) > key['l']:
+                names.update(tokenize_logic(line[key['l']])[1::2])
+        return names
+
+    def renames(self, parent_bounds):
+        """What each field of a top-level group is called in its last iteration, which is the name logic in later
+        groups gets when it refers to the field"""
+        times, show_instance = self.resolved or self.resolve_times(parent_bounds)
+        if times < 1:
+            return {}
+        return dict((cell, self.cell_name("", cell, cell_template, times))
+                for cell, cell_template in zip(self.cells, self.cell_templates))
+
+    def cell_name(self, prefix, cell, cell_template, iteration):
+        if cell_template is not None:
+            return prefix + cell_template.safe_substitute(d=iteration)
+        return "%s%s%d" % (prefix, cell, iteration)
+
+    def expand(self, path, ids, depth, iterations, parent_bounds, branch, pre_logic, last_only=False):
+        if self.record is None:
+            return self.expand_rows(path, ids, depth, iterations, parent_bounds, branch, pre_logic, last_only)
+        started = time.time()
+        new_rows = self.expand_rows(path, ids, depth, iterations, parent_bounds, branch, pre_logic, last_only)
+        self.record.expanded(depth + 1, self.resolved or self.resolve_times(parent_bounds), new_rows, time.time() - started)
+        return new_rows
+
+    def expand_rows(self, path, ids, depth, iterations, parent_bounds, branch, pre_logic, last_only=False):
+        """Expands the group. With last_only, only the last iteration of this and every nested group (and the one
+        before it, which the next iteration's logic is built from) is generated."""
+        options = self.options
+        # ids holds the renames of the enclosing groups, if there are any. This group's own go in a new scope.
+        scope = IdScope(ids)
+        depth += 1
+        new_rows = []
+        if self.resolved is not None:
+            times, show_instance = self.resolved
         else:
-            number_line[key['e']] = "How many %s %s would you like to enter (up to %d)?" % (name.lower() if not name.isupper() else name, options.groups, times)
-            number_line[key['c']] = Template(first[key['c']]).safe_substitute(placeholder = "%s %s" % (name.lower() if not name.isupper() else name, options.groups))
-
-
-        if not options.validation_off:
-            number_line[key['h']] = "integer"
-            number_line[key['i']] = "0"
-            number_line[key['j']] = times
-        logic = first[key['l']]
-        if len(logic.strip()):
-           for pairs in ids.items():
-                id_pair = pairs[1]
-                logic = re.sub(id_pair[0],id_pair[1],logic)
-        if len(pre_logic) and len(logic.strip()):
-            logic = "(%s) and [%s]>=%d"%(logic, pre_logic, iterations[depth-2])
-        elif len(pre_logic):
-            logic = "[%s]>=%d"%(pre_logic, iterations[depth-2])
-
-
-        pre_logic = number_line[key['a']]
-        
-        number_line[key['l']] = logic
-        new_rows.append(number_line)
-
-    for iteration in range(1, times+1):
-        skip = 0
-        # We need to find all the possible keys that might need replacing this time around
-        group_ids = [line[key['a']].split(" ")[0] for line in group]
-        ids.update(dict([("\[%s(?=(]|\())" % re.escape(cell),(re.compile("\[%s(?=(]|\())"% re.escape(cell)), Template("["+prefix+cell).safe_substitute(d=iteration) if "${d}" in cell else "[%s%s%d" % (prefix, cell, iteration))) for cell in group_ids]))
-        for index, line in enumerate(group):
-             if skip:
-                 skip = skip - 1 
-                 continue
-
-             # Section headers
-             if not (options.auto or options.prompt) and not show_instance and index == 0 and iteration == 1:
-                 if not options.groups: #TODO REFACTOR
-                     plural_name = name
-                     plural_match = paren_re.match(plural_name)
-
-                     if plurals.has_key(name.lower()):
-                          plural_name = plurals[name.lower()]
-                     elif plural_match:
-                         plural_name = plural_match.group(1).strip()
-                         plural_name = plural_name.lower() if not plural_name.isupper() else plural_name
-                         plural_name = pluralize(plural_name)
-                         plural_name = plural_name + " " + plural_match.group(2)
-                     else:
-                          plural_name = plural_name.lower() if not plural_name.isupper() else plural_name
-                          plural_name = pluralize(plural_name)
-                     line[key['c']] = Template(line[key['c']]).safe_substitute(placeholder = plural_name)
-                 else:
-                     line[key['c']] = Template(line[key['c']]).safe_substitute(placeholder = "%s %s" % (name.lower() if not name.isupper() else name, options.groups))
-             else:
-                line[key['c']] = ""
-
-             startmatch = begin.match(line[key['a']])
-             if index >= 1 and startmatch:
-                 # found a nested group
-                 new_path = path[:]
-                 new_path.append("%s%d" % (clean_name, iteration))
-                 nested_group = find_group(group[index:])
-                 logger.debug("Found nested Group %s - length %d" % (line[key['a']], len(nested_group)))
-                 logger.debug("Last member is %s" % nested_group[-1][key['a']])
-                 iterations.append(iteration)
-                 new_rows.extend(repeat_group(nested_group, new_path, copy.copy(ids), depth, iterations, group, another_branch, pre_logic))
-                 iterations.pop()
-                 # The number of lines in the nested group represents lines we don't process
-                 # as part of this group
-                 #if nested_group[-1][key['a']] == " endrepeat":
-                 #    skip = len(nested_group)
-                 #else:
-                 skip = len(nested_group)-1
-                 continue
-             # business as usual
-             new_line = line[:]
-             first_cell =  line[key['a']].split(" ")[0]
-             new_line[key['a']] = prefix + (Template(first_cell).safe_substitute(d=iteration) if "${d}" in first_cell else "%s%d" % (first_cell, iteration))
-             
-             # Take care of the prompt for this line
-             # It can do the following things:
-             # If percent %d or %s is found, it will insert the number (1) , or the stringized version of the number there (1st, 2nd)
-             # if $group# is found, it will sub in the appropriate group number in each spot
-             # Failing all else, it will try to find the name in the prompt and add a number after it
-             prompt = line[key['e']]
-             
-             template_map = {}
-             for d in range(0, depth-1):
-                 template_map["d"+str(d+1)]=iterations[d] 
-                 template_map["s"+str(d+1)]=str(iterations[d])+numberEnding(iterations[d])
-             template_map['d'] = iteration
-             template_map['s'] = str(iteration)+numberEnding(iteration)
-             new_line[key['e']] = Template(prompt).safe_substitute(**template_map)
-             #If everything failed, try to replace the group name with group name #
-             
-             if new_line[key['e']] == line[key['e']]:
-                if name_pattern.search(prompt):
-                   new_line[key['e']] = prompt = name_pattern.sub("%s %d" % (name, iteration), prompt)
-             # Determine the Branching Logic
-             logic = line[key['l']]
-
-             # Subsitute in proper var names
-             if len(logic.strip()):
-                for pairs in ids.items():
-                     id_pair = pairs[1]
-                     logic = re.sub(id_pair[0],id_pair[1],logic)
-             # Use the correct scheme for generating the next visible one
-             if (options.auto or options.prompt) and not show_instance: 
-                 if another_branch:
-                     if len(logic.strip()):
-                        new_line[key['l']] = "(%s) and %s" % (logic, another_branch)
-                     else:
-                        new_line[key['l']] = another_branch
-                 else:
-                     new_line[key['l']] = logic
-             else:
-                 if len(logic.strip()):
-                     new_line[key['l']] = "(%s) and %s" % (logic, "[%s]>=%d" % (show_instance, iteration))
-                 else:
-                     new_line[key['l']] = "[%s]>=%d" % (show_instance, iteration)
-
-             # Support for matrix group name
-             if (len(new_line) - 1) >= key['p']:
-                 if new_line[key['p']].strip():
-                     new_line[key['p']] = "%s%s%d" % (prefix, new_line[key['p']],iteration) 
-
-             if options.validation_off:
-                new_line[key['h']] = new_line[key['i']] = new_line[key['j']] = ''
-
-             new_rows.append(new_line)
-        # If using prompt or auto scheme, generate the logic to use for the next group 
-        # If show_instance is defined but one of these is also true, it means this
-        # group repeats a number of times dependent on the answer to another question
-        if options.prompt and iteration < times and not show_instance:
-            another_line = new_line[:]
-            another_line[key['a']] = "%s%s_repeat%s" % (prefix, clean_name, iteration)
-            another_line[key['d']] = "checkbox"
-            another_line[key['e']] = ""
-            another_line[key['f']] = "1, Add another %s?" % name
-            another_branch = "[%s(1)]='1'" % ("%s%s_repeat%s" % (prefix, clean_name, iteration))
-            if iteration == 1:
-                another_line[key['l']] = new_rows[0][key['l']]
+            times, show_instance = self.resolve_times(parent_bounds)
+
+        name = self.name
+        clean_name = self.clean_name
+        prefix = "_".join(path)
+        if len(prefix):
+            prefix = prefix + "_"
+        another_branch = branch
+
+        # If in the default mode, which asks prompts the user up front for the number of items in each repeating group, add that question here
+        # If show_instance is already defined, then it means this group repeats a number determined by a previous question's value
+        if not (options.auto or options.prompt) and not show_instance:
+            number_line = template[:]
+            number_line[key['a']] = show_instance = "%s%s_%s" % (prefix, re.sub(' ','_', clean_name ), "group_no")
+            number_line[key['b']] = self.first[key['b']]
+            number_line[key['d']] = "text"
+            if not options.groups:
+                plural_name = self.expander.plural_name(name)
+                number_line[key['e']] = "How many %s would you like to enter (up to %d)?" % (plural_name, times)
+                number_line[key['c']] = self.expander.templates.substitute(self.header, placeholder = plural_name)
             else:
-                another_line[key['l']] = "[%s(1)]='1'" % ("%s%s_repeat%s" % (prefix, clean_name, iteration-1))
-            new_rows.append(another_line)
-        elif options.auto and iteration < times and not show_instance:
-            # There is a slight complication here because checkboxes can't easily be tested for being null
-            first_prev = group[0]
-            if first_prev[key['d']] == "checkbox":
-                group_cell = first_prev[key['a']].split(" ")[0]
-                choices = first_prev[key['f']].split(" | ")
-                choices = [x.split(",")[0].strip() for x in choices]
-                cell_name = Template(prefix+group_cell).safe_substitute(d = iteration) if "${d}" in group_cell else "%s%s%d" % (prefix, group_cell, iteration)
-                another_branch = "("
-                for choice in choices:
-                    if len(another_branch) > 1:
-                        operator = " or "
+                number_line[key['e']] = "How many %s %s would you like to enter (up to %d)?" % (name.lower() if not name.isupper() else name, options.groups, times)
+                number_line[key['c']] = self.expander.templates.substitute(self.header, placeholder = "%s %s" % (name.lower() if not name.isupper() else name, options.groups))
+
+            if not options.validation_off:
+                number_line[key['h']] = "integer"
+                number_line[key['i']] = "0"
+                number_line[key['j']] = str(times)
+            logic = self.first[key['l']]
+            if len(logic.strip()):
+               logic = rewrite_logic(logic, ids)
+            if len(pre_logic) and len(logic.strip()):
+                logic = "(%s) and [%s]>=%d"%(logic, pre_logic, iterations[depth-2])
+            elif len(pre_logic):
+                logic = "[%s]>=%d"%(pre_logic, iterations[depth-2])
+
+            pre_logic = number_line[key['a']]
+
+            if options.simplify_logic:
+                logic = simplify_logic(logic)
+            number_line[key['l']] = logic
+            new_rows.append(number_line)
+
+        # The iterations of the enclosing groups ($d1, $s1, ...) are the same for every line of every iteration
+        outer_map = {}
+        for d in range(0, depth-1):
+            outer_map["d"+str(d+1)]=iterations[d]
+            outer_map["s"+str(d+1)]=str(iterations[d])+numberEnding(iterations[d])
+
+        for iteration in range(max(1, times-1) if last_only else 1, times+1):
+            # Every field of the group gets a new name this time around
+            for cell, cell_template in zip(self.cells, self.cell_templates):
+                scope[cell] = self.cell_name(prefix, cell, cell_template, iteration)
+
+            # Take care of the prompt for each line
+            # It can do the following things:
+            # If percent %d or %s is found, it will insert the number (1) , or the stringized version of the number there (1st, 2nd)
+            # if $group# is found, it will sub in the appropriate group number in each spot
+            # Failing all else, it will try to find the name in the prompt and add a number after it
+            template_map = dict(outer_map)
+            template_map['d'] = iteration
+            template_map['s'] = str(iteration)+numberEnding(iteration)
+            numbered_name = "%s %d" % (name, iteration)
+
+            for item in self.items:
+                if isinstance(item, GroupPlan):
+                    new_path = path[:]
+                    new_path.append("%s%d" % (clean_name, iteration))
+                    iterations.append(iteration)
+                    new_rows.extend(item.expand(new_path, scope, depth, iterations, None, another_branch, pre_logic,
+                        last_only))
+                    iterations.pop()
+                    continue
+
+                # business as usual
+                field_name = self.cell_name(prefix, item.cell, item.cell_template, iteration)
+
+                prompt = item.prompt
+                if item.prompt_template is not None:
+                    prompt = item.prompt_template.safe_substitute(template_map)
+                #If everything failed, try to replace the group name with group name #
+                if prompt == item.prompt and item.name_split is not None:
+                    prompt = numbered_name.join(item.name_split)
+
+                # Determine the Branching Logic
+                logic = item.logic
+
+                # Subsitute in proper var names
+                if item.has_logic:
+                    logic = rewrite_logic(logic, scope)
+                # Use the correct scheme for generating the next visible one
+                if (options.auto or options.prompt) and not show_instance:
+                    if another_branch:
+                        if item.has_logic:
+                           logic = "(%s) and %s" % (logic, another_branch)
+                        else:
+                           logic = another_branch
+                else:
+                    if item.has_logic:
+                        logic = "(%s) and %s" % (logic, "[%s]>=%d" % (show_instance, iteration))
                     else:
-                        operator = ""
-                    another_branch = another_branch + operator + "[%s(%s)] = '1'" % (cell_name, choice)
-                another_branch = another_branch + ")"
-            else:
-                group_cell = first_prev[key['a']].split(" ")[0]
-                another_branch = '[%s] <> ""' % (Template(prefix+group_cell).safe_substitute(d = iteration) if "${d}" in group_cell else "%s%s%d" % (prefix, group_cell, iteration))
-
-    return new_rows
-
-
-def find_group(lines):
-    group = []
+                        logic = "[%s]>=%d" % (show_instance, iteration)
+
+                if options.simplify_logic:
+                    logic = simplify_logic(logic)
+
+                matrix = None
+                if item.matrix is not None:
+                    matrix = "%s%s%d" % (prefix, item.matrix, iteration)
+
+                new_line = ExpandedRow(item.skeleton, field_name, prompt, logic, matrix)
+                new_rows.append(new_line)
+            # If using prompt or auto scheme, generate the logic to use for the next group
+            # If show_instance is defined but one of these is also true, it means this
+            # group repeats a number of times dependent on the answer to another question
+            if options.prompt and iteration < times and not show_instance:
+                another_line = new_line[:]
+                another_line[key['a']] = "%s%s_repeat%s" % (prefix, clean_name, iteration)
+                another_line[key['d']] = "checkbox"
+                another_line[key['e']] = ""
+                another_line[key['f']] = "1, Add another %s?" % name
+                another_branch = "[%s(1)]='1'" % ("%s%s_repeat%s" % (prefix, clean_name, iteration))
+                if iteration == 1:
+                    another_line[key['l']] = new_rows[0][key['l']]
+                else:
+                    another_line[key['l']] = "[%s(1)]='1'" % ("%s%s_repeat%s" % (prefix, clean_name, iteration-1))
+                new_rows.append(another_line)
+            elif options.auto and iteration < times and not show_instance:
+                # There is a slight complication here because checkboxes can't easily be tested for being null
+                cell_name = self.cell_name(prefix, self.first_cell, self.first_cell_template, iteration)
+                if self.first_is_checkbox:
+                    another_branch = "(%s)" % " or ".join(["[%s(%s)] = '1'" % (cell_name, choice) for choice in self.first_choices])
+                else:
+                    another_branch = '[%s] <> ""' % cell_name
+
+        return new_rows
+
+
+class GroupStats(object):
+    """What happened to one repeating group during a run. A nested group is expanded once for every iteration
+    of its parent, those expansions are added up. Times and row counts include any nested groups."""
+
+    def __init__(self, field, input_rows):
+        self.field = field
+        self.input_rows = input_rows
+        self.depth = None
+        self.times = None
+        self.show_instance = None
+        self.expansions = 0
+        self.output_rows = 0
+        self.longest_logic = 0
+        self.seconds = 0.0
+        self.cached = False
+
+    def expanded(self, depth, resolved, rows, seconds):
+        self.depth = depth
+        self.times, self.show_instance = resolved
+        self.expansions += 1
+        self.output_rows += len(rows)
+        for row in rows:
+            if len(row) > key['l'] and len(row[key['l']]) > self.longest_logic:
+                self.longest_logic = len(row[key['l']])
+        self.seconds += seconds
+
+    def report(self):
+        return {
+            'field': self.field,
+            'depth': self.depth,
+            'times': self.times,
+            'count_field': self.show_instance,
+            'expansions': self.expansions,
+            'input_rows': self.input_rows,
+            'output_rows': self.output_rows,
+            'longest_logic': self.longest_logic,
+            'seconds': self.seconds,
+            'cached': self.cached,
+        }
+
+
+class RunStats(object):
+    """Timings and per group metrics for one run, written out by --stats"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.input_rows = 0
+        self.output_rows = 0
+        self.preprocess_seconds = 0.0
+        self.expand_seconds = 0.0
+        self.groups = []
+
+    def add_group(self, field, input_rows):
+        record = GroupStats(field, input_rows)
+        self.groups.append(record)
+        return record
+
+    def report(self, expander=None):
+        total = time.time() - self.started
+        report = {
+            'input_rows': self.input_rows,
+            'output_rows': self.output_rows,
+            'seconds': {
+                'total': total,
+                'preprocess': self.preprocess_seconds,
+                'expand': self.expand_seconds,
+                'read_and_write': max(0.0, total - self.preprocess_seconds - self.expand_seconds),
+            },
+            'groups': [record.report() for record in self.groups],
+        }
+        try:
+            import resource
+            report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except ImportError:
+            pass
+        if expander is not None:
+            report['template_cache'] = {'hits': expander.templates.hits, 'misses': expander.templates.misses}
+        if expander is not None and expander.cache is not None:
+            report['group_cache'] = {'hits': expander.cache.hits, 'misses': expander.cache.misses}
+        return report
+
+
+def repeat_group(group, path=None, ids=None, depth=0, iterations=None, parent_group=None, branch="", pre_logic="",
+        expander=None):
+    if expander is None:
+        expander = Expander(options)
+    if ids is not None and not isinstance(ids, IdScope):
+        scope = IdScope()
+        scope.ids.update(ids)
+        ids = scope
+    return [as_list(row) for row in GroupPlan(group, expander).expand(path or [], ids, depth, iterations or [],
+            FieldBounds(parent_group or []), branch, pre_logic)]
+
+
+def find_group(lines, start=0):
+    """The group that starts at lines[start], or None if it is never closed"""
     depth = 0
-    for line in lines:
-        startmatch = begin.match(line[key['a']])
-        endmatch = end.match(line[key['a']])
-        group.append(line)
-        if startmatch:
+    for index in xrange(start, len(lines)):
+        marker = classify(lines[index][key['a']])
+        if marker.opens:
             depth += 1
-        if endmatch or (startmatch and startmatch.group(2)=="repeat"):
+        if marker.closes:
             depth -= 1
         if depth == 0:
-            return group
-
-
-def main(input_file, output_file):
-
-    temp_file = os.tmpfile() 
-    if type(input_file) is str:
-       handle_in = open(input_file, 'rU')
-       handle_out = open(output_file, 'wb')
-    else:
-       handle_in = input_file
-       handle_out = output_file
-
-    input_f = csv.reader(handle_in)
-    output_f = csv.writer(temp_file)
-
-    # this is the preprocessor 
-    for line in input_f:
-        for generated_line in dispatch[line[key['d']]](line):
-            output_f.writerow(generated_line)
-
-    temp_file.seek(0)
-    handle_in.close()
-    
-    input_f = csv.reader(temp_file)
-    output_f = csv.writer(handle_out)
-
-    # now handle repeating groups
-    outer_group=[]
+            return lines[start:index + 1]
+
+
+def open_input(input_file):
+    """Returns a handle for reading the data dictionary, "-" means stdin"""
+    if input_file == "-":
+        return sys.stdin
+    return open(input_file, 'rU')
+
+def open_output(output_file):
+    """Returns a handle for writing the data dictionary, "-" means stdout"""
+    if output_file == "-":
+        return sys.stdout
+    return open(output_file, 'wb')
+
+def read_rows(handle):
+    for line in csv.reader(handle):
+        yield line
+
+def preprocess(rows, stats=None):
+    """Expands the custom datatypes of each row through the dispatch table"""
+    for line in rows:
+        if stats is not None:
+            started = time.time()
+        # Handlers return lists of string cells, just as the csv reader does
+        generated = dispatch[line[key['d']]](line)
+        if stats is not None:
+            stats.preprocess_seconds += time.time() - started
+            stats.input_rows += 1
+        for generated_line in generated:
+            yield generated_line
+
+def find_groups(rows):
+    """Yields (False, row) for every row outside a repeating group and (True, rows) for every top-level group"""
     group = []
     depth = 0
-    for line in input_f:
-        startmatch = begin.match(line[key['a']])
-        endmatch = end.match(line[key['a']])
+    for line in rows:
+        marker = classify(line[key['a']])
 
-        if startmatch:
+        if marker.opens:
             depth += 1
         if depth:
             group.append(line)
         else:
-            output_f.writerow(line)
-            outer_group.append(line)
-        if endmatch or (startmatch and startmatch.group(2)=="repeat"):
+            yield False, line
+        if marker.closes:
             depth -= 1
 
         if depth == 0 and len(group):
             logger.debug("Found group %s, length - %d" % (group[0][key['a']], len(group)))
-            for row in repeat_group(group, parent_group = outer_group):
-                output_f.writerow(row)
+            yield True, group
             group = []
 
-    temp_file.close()
-    if type(input_file) is str:
-       handle_out.close()
+def expand_groups(rows, expander, stats=None, lineage=None, instruments=None):
+    """Passes plain rows through and replaces each top-level repeating group with its expansion"""
+    # A top-level group looks up its repeat count among the plain rows before it
+    bounds = FieldBounds()
+    # What the fields of the groups so far are called now
+    renames = IdScope()
+    output = GroupOutput(expander, stats, lineage, instruments)
+    for is_group, line in find_groups(rows):
+        if not is_group:
+            for row in output.plain(line):
+                yield row
+            bounds.add(line)
+        elif output.takes(line):
+            output.instrument(line)
+        else:
+            group = line
+            if stats is None:
+                rows = expander.expand_group(group, bounds, lineage=lineage, renames=renames)
+            else:
+                started = time.time()
+                rows = expander.expand_group(group, bounds, stats, lineage, renames)
+                stats.expand_seconds += time.time() - started
+            for row in output.group(group, bounds, rows):
+                yield row
+    for row in output.finish():
+        yield row
+
+def unit_size(unit):
+    if isinstance(unit, int):
+        return unit
+    return sum(unit_size(part) for part in unit)
+
+def form_of(row):
+    return row[key['b']] if len(row) > key['b'] else ""
+
+class FormSplitter(object):
+    """Moves rows on to continuation forms (form_2, form_3, ...) once a form has max_fields fields, so no page
+    gets too big to load. The field names don't change, so branching logic that refers to a field on an earlier
+    form keeps working. Rows of a repeating group are only moved between iterations. An iteration with more
+    than max_fields fields on a form is split between the iterations of the groups nested in it, and failing
+    that gets a form of its own."""
+
+    def __init__(self, max_fields):
+        self.max_fields = max_fields
+        # For each form of the input: the form its rows go on now, how many that one has and its number
+        self.names = {}
+        self.counts = Counter()
+        self.continuations = Counter()
+
+    def next_form(self, form):
+        self.continuations[form] += 1
+        self.names[form] = "%s_%d" % (form, self.continuations[form] + 1)
+        self.counts[form] = 0
+
+    def move(self, row):
+        name = self.names.get(form_of(row))
+        if name is None:
+            return row
+        row = row[:] if type(row) is list else row.to_list()
+        row[key['b']] = name
+        return row
+
+    def plain(self, row):
+        form = form_of(row)
+        if self.counts[form] >= self.max_fields:
+            self.next_form(form)
+        self.counts[form] += 1
+        return self.move(row)
+
+    def group(self, rows, units):
+        """Returns the rows of a top-level group, as laid out by GroupPlan.units, on the forms they go on"""
+        placed = []
+        self.place(rows, 0, units, placed)
+        return placed
+
+    def place(self, rows, start, units, placed):
+        max_fields = self.max_fields
+        for unit in units:
+            size = unit_size(unit)
+            forms = Counter(form_of(row) for row in rows[start:start + size])
+            if not isinstance(unit, int) and any(self.counts[form] + fields > max_fields for form, fields in forms.items()) \
+                    and any(fields > max_fields for fields in forms.values()):
+                # Too big to go on a form of its own
+                self.place(rows, start, unit, placed)
+            else:
+                for form, fields in forms.items():
+                    if self.counts[form] and self.counts[form] + fields > max_fields:
+                        self.next_form(form)
+                    self.counts[form] += fields
+                for row in rows[start:start + size]:
+                    placed.append(self.move(row))
+            start += size
+
+class NativeInstruments(object):
+    """Puts each top-level repeating group on a REDCap repeating instrument of its own (options.native), with
+    its fields written once and no iteration numbers, instead of expanding it. Groups that can't be (ones with
+    nested groups or a [field] count, which an instrument can't follow) are expanded as usual, with a warning.
+    REDCap needs the fields of a form to be together, so an instrument is held back until the form its group
+    was on has ended. instruments, if given, is called with the name of each instrument and the label REDCap
+    should give its instances."""
+
+    def __init__(self, lineage=None, instruments=None):
+        self.lineage = lineage
+        self.instruments = instruments
+        self.forms = set()
+        # Field name to instrument, for the logic outside an instrument that refers to its fields
+        self.fields = {}
+        self.held = []
+        self.held_form = None
+
+    def takes(self, group):
+        marker = classify(group[0][key['a']])
+        if not marker.opens:
+            # Left for the expansion to report
+            return False
+        reason = None
+        if any(classify(line[key['a']]).opens for line in group[1:]):
+            reason = "it has groups nested in it"
+        elif other_id_re.match(marker.count):
+            reason = "it repeats as many times as %s says, which a repeating instrument can't follow" % marker.count
+        elif not marker.count.isdigit():
+            # Left for the expansion to report
+            return False
+        if reason is not None:
+            logger.warning("%s is expanded rather than made a repeating instrument, as %s" % (group[0][key['a']], reason))
+            return False
+        return True
+
+    def take(self, group):
+        """Returns the rows of the group's instrument, which are held back until the form they interrupt ends"""
+        first = group[0]
+        if first != group[-1] and classify(group[-1][key['a']]).bare_end:
+            group = group[:-1]
+        marker = classify(first[key['a']])
+        form = form_of(first)
+        self.forms.add(form)
+
+        name = base = re.sub("[^a-z0-9_]", "_", clean(marker.name)).strip("_") or "repeating"
+        number = 1
+        while name in self.forms:
+            number += 1
+            name = "%s_%d" % (base, number)
+        self.forms.add(name)
+
+        rows = []
+        for line in group:
+            row = line[:]
+            field = classify(line[key['a']]).id.replace("${d}", "")
+            row[key['a']] = field
+            row[key['b']] = name
+            # There is only one copy of each field, the instance number stands in for the iteration
+            row[key['e']] = templates.substitute(line[key['e']], d="[current-instance]", s="[current-instance]")
+            if line is first:
+                row[key['c']] = templates.substitute(line[key['c']], placeholder=marker.name)
+            rows.append(row)
+            self.fields[field] = name
+        if self.lineage is not None:
+            self.lineage([(row[key['a']], row[key['a']], name, "instrument", (clean(marker.name),), ())
+                    for row in rows])
+        if self.instruments is not None:
+            self.instruments(name, "[%s]" % rows[0][key['a']])
+
+        # Anything already held for an earlier form can go out with it
+        self.held.extend(rows)
+        self.held_form = form
+        return rows
+
+    def emit(self, rows):
+        """Returns rows with any held instruments put in where the form they were held for ends"""
+        if self.fields:
+            for row in rows:
+                if len(row) > key['l'] and row[key['l']]:
+                    tokens = tokenize_logic(row[key['l']])
+                    for index in range(1, len(tokens), 2):
+                        if tokens[index] in self.fields and form_of(row) != self.fields[tokens[index]]:
+                            logger.warning("The branching logic of %s refers to %s of the repeating instrument %s, it"
+                                    " may need to say which instance with [%s][instance]" % (row[key['a']], tokens[index],
+                                    self.fields[tokens[index]], tokens[index]))
+        for row in rows:
+            self.forms.add(form_of(row))
+        if not self.held:
+            return rows
+        for index, row in enumerate(rows):
+            if form_of(row) != self.held_form:
+                held = self.held
+                self.held = []
+                return list(rows[:index]) + held + list(rows[index:])
+        return rows
+
+    def finish(self):
+        held = self.held
+        self.held = []
+        return held
+
+class GroupOutput(object):
+    """What happens to plain rows and expanded top-level groups on their way out of expand_groups and
+    expand_groups_parallel: they are counted, split between forms with options.max_fields and have repeating
+    instruments put in between them with options.native. Each method returns the rows to hand on."""
+
+    def __init__(self, expander, stats=None, lineage=None, instruments=None):
+        options = expander.options
+        self.expander = expander
+        self.stats = stats
+        self.splitter = FormSplitter(options.max_fields) if options.max_fields else None
+        self.native = NativeInstruments(lineage, instruments) if options.native else None
+
+    def takes(self, group):
+        """Whether the group is made a repeating instrument instead of being expanded"""
+        return self.native is not None and self.native.takes(group)
+
+    def instrument(self, group):
+        rows = self.native.take(group)
+        if self.splitter is not None:
+            # The rows of the group's form are going on its latest continuation, so the instrument waits for that
+            native = self.native
+            native.held_form = self.splitter.names.get(native.held_form, native.held_form)
+        if self.stats is not None:
+            self.stats.output_rows += len(rows)
+
+    def plain(self, line):
+        if self.stats is not None:
+            self.stats.output_rows += 1
+        row = line if self.splitter is None else self.splitter.plain(line)
+        return [row] if self.native is None else self.native.emit([row])
+
+    def group(self, group, bounds, rows):
+        """The expansion rows of group, which looked up its repeat count in bounds"""
+        if self.stats is not None:
+            self.stats.output_rows += len(rows)
+        if self.splitter is not None:
+            rows = self.splitter.group(rows, GroupPlan(group, self.expander).units(bounds))
+        if self.native is not None:
+            rows = self.native.emit(rows)
+        return rows
+
+    def finish(self):
+        return self.native.finish() if self.native is not None else []
+
+def group_bounds(group, bounds):
+    """The part of bounds a top-level group looks up its repeat count in. Only a count of the form [other_id]
+    needs any."""
+    marker = classify(group[0][key['a']])
+    other_id_match = marker.opens and other_id_re.match(marker.count)
+    if other_id_match:
+        return bounds.subset(other_id_match.group(1))
+    return FieldBounds()
+
+# The Expander each worker process of expand_groups_parallel uses, sent over once when the pool starts
+worker_expander = None
+
+def group_worker_init(expander):
+    global worker_expander
+    worker_expander = expander
+
+def group_worker(job):
+    """Expands a top-level group in a worker process. Returns the rows, the group's stats and lineage if they
+    were asked for, the time taken and the group cache hits and misses."""
+    group, bounds, referenced, collect_stats, collect_lineage = job
+    expander = worker_expander
+    renames = IdScope()
+    renames.ids.update(referenced)
+    stats = RunStats() if collect_stats else None
+    cache = expander.cache
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    fields = [] if collect_lineage else None
+    started = time.time()
+    rows = expander.expand_group(group, bounds, stats, fields.extend if collect_lineage else None, renames)
+    elapsed = time.time() - started
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    return rows, stats.groups if stats is not None else None, fields, elapsed, hits, misses
+
+def expand_groups_parallel(rows, expander, jobs, stats=None, lineage=None, instruments=None, max_buffered=10000):
+    """The same as expand_groups, but the top-level groups are expanded by a pool of worker processes. Each
+    group only takes the bound its repeat count is looked up in and the renames of the earlier fields its logic
+    refers to along with it. Rows come out in their original order. The output waits for the oldest group once
+    two groups per worker are being expanded, or once max_buffered input rows (those of the groups and the
+    plain rows behind it) are held back."""
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, group_worker_init, (expander,))
+    # Plain rows and groups being expanded, in output order
+    pending = deque()
+    in_flight = 0
+    buffered = 0
+    bounds = FieldBounds()
+    renames = {}
+    output = GroupOutput(expander, stats, lineage, instruments)
+    try:
+        # A last (None, None) flushes whatever is still pending
+        for is_group, line in itertools.chain(find_groups(rows), [(None, None)]):
+            finished = is_group is None
+            if is_group and output.takes(line):
+                # Made into an instrument when its turn comes, a group marked None
+                pending.append((None, line))
+                buffered += len(line)
+            elif is_group:
+                job_bounds = group_bounds(line, bounds)
+                # The renames only depend on the group's structure, so later groups need not wait for this one
+                plan = GroupPlan(line, expander)
+                referenced = dict((cell, renames[cell]) for cell in plan.references() if cell in renames)
+                renames.update(plan.renames(job_bounds))
+                job = (line, job_bounds, referenced, stats is not None, lineage is not None)
+                pending.append((True, (pool.apply_async(group_worker, (job,)), job)))
+                in_flight += 1
+                buffered += len(line)
+            elif not finished:
+                pending.append((False, line))
+                buffered += 1
+                bounds.add(line)
+
+            # Hand on everything that is ready, waiting for the oldest group when too much is in flight
+            while pending and (not pending[0][0] or pending[0][1][0].ready() or in_flight >= 2 * jobs
+                    or buffered >= max_buffered or finished):
+                is_group, item = pending.popleft()
+                if is_group is None:
+                    buffered -= len(item)
+                    output.instrument(item)
+                    continue
+                if not is_group:
+                    buffered -= 1
+                    for row in output.plain(item):
+                        yield row
+                    continue
+                in_flight -= 1
+                result, job = item
+                buffered -= len(job[0])
+                group_rows, groups, fields, elapsed, hits, misses = result.get()
+                if lineage is not None:
+                    lineage(fields)
+                if stats is not None:
+                    stats.groups.extend(groups)
+                    stats.expand_seconds += elapsed
+                if expander.cache is not None:
+                    expander.cache.hits += hits
+                    expander.cache.misses += misses
+                for row in output.group(job[0], job[1], group_rows):
+                    yield row
+        for row in output.finish():
+            yield row
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+source_hash = None
+
+def get_source_hash():
+    """A hash of this script, so cached expansions are thrown away whenever the code changes"""
+    global source_hash
+    if source_hash is None:
+        source = open(os.path.splitext(__file__)[0] + ".py", 'rb')
+        try:
+            import hashlib
+            source_hash = hashlib.sha1(source.read()).hexdigest()
+        finally:
+            source.close()
+    return source_hash
+
+class GroupCache(object):
+    """An on-disk cache of expanded top-level groups. Each entry is a csv file of the expanded rows, named after
+    a hash of everything the expansion depends on. Once there are more than max_entries files the least
+    recently used ones are removed."""
+
+    def __init__(self, directory, max_entries=1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.entries = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, *parts):
+        import hashlib
+        return hashlib.sha1(repr((get_source_hash(),) + parts)).hexdigest()
+
+    def path(self, cache_key):
+        return os.path.join(self.directory, cache_key + ".csv")
+
+    def get(self, cache_key):
+        """Returns the rows for the key, or None if they are not cached"""
+        path = self.path(cache_key)
+        try:
+            handle = open(path, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            rows = list(csv.reader(handle))
+        finally:
+            handle.close()
+        # Mark it as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return rows
+
+    def put(self, cache_key, rows):
+        import tempfile
+        path = self.path(cache_key)
+        # A temporary file of its own, as other threads and processes may be writing the same entry
+        descriptor, temp_path = tempfile.mkstemp(".tmp", cache_key + ".", self.directory)
+        handle = os.fdopen(descriptor, 'wb')
+        try:
+            csv.writer(handle).writerows([row if type(row) is list else row.to_list() for row in rows])
+        finally:
+            handle.close()
+        # Renaming is atomic, so other processes sharing the cache never see half an entry
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Some platforms won't rename over an existing file. Another writer got there first with the same rows.
+            os.remove(temp_path)
+
+        if self.entries is None:
+            self.entries = len(self.listing())
+        else:
+            self.entries += 1
+        if self.entries > self.max_entries:
+            self.evict()
+
+    def listing(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".csv")]
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is back within max_entries"""
+        entries = []
+        for path in self.listing():
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        entries.sort()
+        for mtime, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.entries = min(len(entries), self.max_entries)
+
+    def clear(self):
+        for path in self.listing():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.entries = 0
+
+
+class Expander(object):
+    """Expands data dictionary rows with one set of options. Everything an expansion needs is kept per call
+    to expand() or on the Expander, so an Expander can be shared between threads and many can run side by side.
+    The module level caches only hold parsed strings, whatever the options.
+
+    options is anything with the attributes of the command line options (auto, prompt, groups, validation_off,
+    max_repeat, simplify_logic, plurals, group_jobs, max_fields, native) and defaults to FakeOptions. plurals
+    maps lower case group names to their plural. If it is not given, the file named by options.plurals is read
+    the first time a group name needs pluralizing. If a GroupCache is given, top-level groups that have not
+    changed since they were last expanded are read back from it."""
+
+    def __init__(self, options=None, plurals=None, cache=None):
+        self.options = options if options is not None else FakeOptions()
+        self.plurals = plurals
+        self.plural_names = {}
+        self.cache = cache
+        self.settings = None
+        # The field names, prompts and section headers of the groups expanded, parsed once
+        self.templates = TemplateCache()
+
+    def expand(self, rows, stats=None, lineage=None, instruments=None):
+        """Takes an iterable of rows (lists of cells) and returns an iterator over the expanded rows, each a list
+        of its own. Pass a RunStats to have timings and per group metrics collected as the rows go by. lineage,
+        if given, is called with the fields of each top-level group (as GroupPlan.lineage yields them) before the
+        group's rows come out. With options.native, instruments is called with the name and instance label of
+        every repeating instrument made. With options.group_jobs above 1, top-level groups are expanded by that
+        many worker processes."""
+        return itertools.imap(as_list, self.expand_rows(rows, stats, lineage, instruments))
+
+    def expand_rows(self, rows, stats=None, lineage=None, instruments=None):
+        """The same as expand(), but the rows of repeating groups come out as read only ExpandedRows, which
+        share the cells that are the same in every iteration. For writers, which copy the cells anyway."""
+        if self.options.group_jobs > 1:
+            return expand_groups_parallel(preprocess(rows, stats), self, self.options.group_jobs, stats, lineage,
+                    instruments)
+        return expand_groups(preprocess(rows, stats), self, stats, lineage, instruments)
+
+    def expand_group(self, group, parent_bounds, stats=None, lineage=None, renames=None):
+        """Expands one top-level group. renames is the IdScope holding what the fields of the groups before it
+        in the dictionary were renamed to, so logic that refers to them gets the new names. It is updated with
+        this group's fields."""
+        plan = GroupPlan(group, self, stats=stats)
+        if lineage is not None:
+            lineage(plan.lineage([], (), (), parent_bounds))
+        if self.cache is None:
+            rows = plan.expand([], renames, 0, [], parent_bounds, "", "")
+        else:
+            rows = self.cached_group(plan, parent_bounds, renames)
+        if renames is not None:
+            renames.ids.update(plan.renames(parent_bounds))
+        return rows
+
+    def cached_group(self, plan, parent_bounds, renames):
+        # The output depends on the group itself, the settings, how many times it repeats (which may come
+        # from another field's maximum) and the names of the fields of earlier groups its logic refers to
+        times, show_instance = plan.resolve_times(parent_bounds)
+        referenced = []
+        if renames is not None:
+            referenced = sorted((cell, renames.ids[cell]) for cell in plan.references() if cell in renames.ids)
+        cache_key = self.cache.key(self.cache_settings(), times, show_instance, referenced, plan.group)
+
+        rows = self.cache.get(cache_key)
+        if rows is not None:
+            if plan.record is not None:
+                plan.record.cached = True
+                plan.record.expanded(1, (times, show_instance), rows, 0.0)
+            return rows
+
+        rows = plan.expand([], renames, 0, [], parent_bounds, "", "")
+        self.cache.put(cache_key, rows)
+        return rows
+
+    def estimate(self, rows):
+        """A dry run. Works out the size of the expanded dictionary without generating it: the number of rows
+        each top-level group and each form ends up with, and the length of the longest branching logic. Only
+        the last iteration of each group is generated to measure the logic, so this takes time in proportion
+        to the size of the input rather than the output. With options.native, groups made into repeating
+        instruments count once, on the instrument's form. Splitting forms with options.max_fields is left out."""
+        forms = Counter()
+        groups = []
+        longest_logic = 0
+        bounds = FieldBounds()
+        renames = IdScope()
+        native = NativeInstruments() if self.options.native else None
+        for is_group, line in find_groups(preprocess(rows)):
+            if not is_group:
+                forms[form_of(line)] += 1
+                if native is not None:
+                    native.forms.add(form_of(line))
+                if len(line) > key['l']:
+                    longest_logic = max(longest_logic, len(line[key['l']]))
+                bounds.add(line)
+                continue
+            if native is not None and native.takes(line):
+                instrument_rows = native.take(line)
+                native.finish()
+                group_logic = max(len(row[key['l']]) if len(row) > key['l'] else 0 for row in instrument_rows)
+                longest_logic = max(longest_logic, group_logic)
+                forms[instrument_rows[0][key['b']]] += len(instrument_rows)
+                groups.append({
+                    'field': line[0][key['a']],
+                    'times': None,
+                    'instrument': instrument_rows[0][key['b']],
+                    'output_rows': len(instrument_rows),
+                    'forms': {instrument_rows[0][key['b']]: len(instrument_rows)},
+                    'longest_logic': group_logic,
+                })
+                continue
+            plan = GroupPlan(line, self)
+            group_forms = plan.size(bounds)
+            forms.update(group_forms)
+            times, show_instance = plan.resolve_times(bounds)
+            group_logic = 0
+            for row in plan.expand([], renames, 0, [], bounds, "", "", last_only=True):
+                if len(row) > key['l']:
+                    group_logic = max(group_logic, len(row[key['l']]))
+            renames.ids.update(plan.renames(bounds))
+            longest_logic = max(longest_logic, group_logic)
+            if native is not None:
+                native.forms.update(group_forms)
+            groups.append({
+                'field': line[0][key['a']],
+                'times': times,
+                'instrument': None,
+                'output_rows': sum(group_forms.values()),
+                'forms': dict((form, count) for form, count in group_forms.items() if count),
+                'longest_logic': group_logic,
+            })
+        return {
+            'output_rows': sum(forms.values()),
+            'forms': dict((form, count) for form, count in forms.items() if count),
+            'groups': groups,
+            'longest_logic': longest_logic,
+        }
+
+    def get_plurals(self):
+        if self.plurals is None:
+            self.plurals = load_plurals(self.options.plurals) if self.options.plurals else {}
+        return self.plurals
+
+    def plural_name(self, name):
+        """The plural of a group name. Nested groups ask for the same names over and over, so they are cached"""
+        plural = self.plural_names.get(name)
+        if plural is None:
+            plural = self.plural_names[name] = plural_group_name(name, self.get_plurals())
+        return plural
+
+    def lineage(self, rows):
+        """Yields where each field of the expanded dictionary came from, as GroupPlan.lineage does. Fields
+        outside repeating groups are left out."""
+        bounds = FieldBounds()
+        for is_group, line in find_groups(preprocess(rows)):
+            if not is_group:
+                bounds.add(line)
+                continue
+            for field in GroupPlan(line, self).lineage([], (), (), bounds):
+                yield field
+
+    def cache_settings(self):
+        """Everything other than the group itself that changes how a group is expanded"""
+        if self.settings is None:
+            options = self.options
+            load_pluralizer()
+            self.settings = (options.prompt, options.auto, options.groups, options.validation_off, options.max_repeat,
+                    options.simplify_logic, sorted(self.get_plurals().items()), have_inflector)
+        return self.settings
+
+
+def write_rows(handle, rows):
+    output_f = csv.writer(handle)
+    for row in rows:
+        output_f.writerow(row if type(row) is list else row.to_list())
+
+
+# Writers each turn the expanded dictionary into one kind of output. main() hands every expanded row to write(),
+# the fields of every top-level group to lineage() and each repeating instrument made to instrument() if the
+# writer has them, and calls close() at the end.
+
+class CsvWriter(object):
+    """The expanded dictionary as a csv file, ready to upload to REDCap"""
+
+    def __init__(self, handle):
+        self.writer = csv.writer(handle)
+
+    def write(self, row):
+        self.writer.writerow(row if type(row) is list else row.to_list())
+
+    def close(self):
+        pass
+
+# The names REDCap's API gives the data dictionary columns
+metadata_fields = ["field_name", "form_name", "section_header", "field_type", "field_label",
+        "select_choices_or_calculations", "field_note", "text_validation_type_or_show_slider_number",
+        "text_validation_min", "text_validation_max", "identifier", "branching_logic", "required_field",
+        "custom_alignment", "question_number", "matrix_group_name", "matrix_ranking", "field_annotation"]
+# One field's object with the (already encoded) cells left to fill in, the same as json.dumps of an OrderedDict
+metadata_template = "{%s}" % ", ".join('"%s": %%s' % name for name in metadata_fields)
+
+class MetadataWriter(object):
+    """The expanded dictionary as the JSON REDCap's API takes to import metadata, a list with an object per
+    field. The first row is the header and is left out. Each field is written out as it comes."""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.handle.write("[")
+        self.rows = 0
+
+    def write(self, row):
+        self.rows += 1
+        if self.rows == 1:
+            return
+        cells = row if type(row) is list else row.to_list()
+        cells = cells[:len(metadata_fields)] + [""] * (len(metadata_fields) - len(cells))
+        self.handle.write("%s\n%s" % ("," if self.rows > 2 else "",
+                metadata_template % tuple(encode_string(cell) for cell in cells)))
+
+    def close(self):
+        self.handle.write("\n]\n")
+
+
+lineage_header = ["field_name", "source_field", "form_name", "kind", "group_path", "iterations"]
+
+class LineageWriter(object):
+    """A csv mapping every field generated from the input to its source field, the path of repeating groups it
+    sits in (clean group names joined by "/") and the iteration of each (joined by ".")"""
+
+    def __init__(self, handle):
+        self.writer = csv.writer(handle)
+        self.writer.writerow(lineage_header)
+
+    def write(self, row):
+        pass
+
+    def lineage(self, fields):
+        for name, source, form, kind, groups, iterations in fields:
+            self.writer.writerow([name, source, form, kind, "/".join(groups), ".".join(str(i) for i in iterations)])
+
+    def close(self):
+        pass
+
+class RepeatingInstrumentsWriter(object):
+    """A csv of the repeating instruments made with options.native, as REDCap's API imports them"""
+
+    def __init__(self, handle):
+        self.writer = csv.writer(handle)
+        self.writer.writerow(["form_name", "custom_form_label"])
+
+    def write(self, row):
+        pass
+
+    def instrument(self, name, label):
+        self.writer.writerow([name, label])
+
+    def close(self):
+        pass
+
+def write_outputs(rows, expander, writers, stats=None):
+    """Expands rows once, handing the result to each of the writers"""
+    lineage_writers = [writer for writer in writers if hasattr(writer, 'lineage')]
+    lineage = None
+    if lineage_writers:
+        def lineage(fields):
+            fields = list(fields)
+            for writer in lineage_writers:
+                writer.lineage(fields)
+    instrument_writers = [writer for writer in writers if hasattr(writer, 'instrument')]
+    instruments = None
+    if instrument_writers:
+        def instruments(name, label):
+            for writer in instrument_writers:
+                writer.instrument(name, label)
+
+    if len(writers) == 1 and isinstance(writers[0], CsvWriter):
+        # The usual case, without a call per row
+        write = writers[0].writer.writerow
+        for row in expander.expand_rows(rows, stats):
+            write(row if type(row) is list else row.to_list())
+    else:
+        for row in expander.expand_rows(rows, stats, lineage, instruments):
+            for writer in writers:
+                writer.write(row)
+    for writer in writers:
+        writer.close()
+
+def main(input_file, output_file, expander=None, stats=None, writers=()):
+    # input_file and output_file can be file names ("-" for stdin/stdout) or already open handles. writers are
+    # more outputs written from the same expansion, e.g. [MetadataWriter(handle)]. output_file can be None if
+    # they are all that is wanted.
+    if expander is None:
+        expander = Expander(options)
+    handle_in = open_input(input_file) if isinstance(input_file, basestring) else input_file
+    handle_out = None
+    if output_file is not None:
+        handle_out = open_output(output_file) if isinstance(output_file, basestring) else output_file
+        writers = [CsvWriter(handle_out)] + list(writers)
+
+    # Rows flow lazily from one stage to the next, so only the current repeating group is held in memory
+    try:
+        write_outputs(read_rows(handle_in), expander, list(writers), stats)
+        logger.debug("Template cache: %d hits, %d misses (%.1f%% hit rate)" % (expander.templates.hits,
+            expander.templates.misses, expander.templates.hit_rate() * 100))
+        if expander.cache is not None:
+            logger.debug("Group cache: %d hits, %d misses" % (expander.cache.hits, expander.cache.misses))
+    finally:
+        if handle_in is not input_file and handle_in is not sys.stdin:
+            handle_in.close()
+        if handle_out is not None and handle_out is not output_file and handle_out is not sys.stdout:
+            handle_out.close()
+
+
+# The field types REDCap itself knows, the custom ones are the keys of dispatch
+redcap_types = set(["text", "notes", "dropdown", "radio", "checkbox", "yesno", "truefalse", "calc", "file", "slider",
+        "descriptive", "sql"])
+choice_types = set(["dropdown", "radio", "checkbox"])
+# Anything in column A after a space is meant to be a repeat marker
+marker_re = re.compile(r'\S* ')
+
+def group_logic(logic, group, numbers, group_number):
+    """Adds the logic of each row of a top-level group to the list check() goes through, along with the source
+    names of the group's fields"""
+    cells = set(classify(line[key['a']]).id for line in group)
+    for number, line in zip(numbers, group):
+        logic.append((number, line[key['l']], group_number, cells))
+
+def check(rows, expander):
+    """Looks for everything that would stop the dictionary from expanding, or make it expand to something
+    other than intended, in one pass without expanding it. Returns a list of (row number, message) with the
+    header as row 1."""
+    issues = []
+    options = expander.options
+
+    # Custom types first, keeping track of the input row each preprocessed row came from
+    lines = []
+    for number, row in enumerate(rows, 1):
+        if number == 1:
+            continue
+        if len(row) <= key['l']:
+            issues.append((number, "Row has %d columns, expected at least %d" % (len(row), key['l'] + 1)))
+            continue
+        kind = row[key['d']]
+        if kind not in redcap_types and kind not in dispatch and not (kind == "" and classify(row[key['a']]).end):
+            issues.append((number, "Unknown field type '%s'" % kind))
+        elif kind in choice_types and parse_choices(row[key['f']]).labels is None:
+            issues.append((number, "Choices need a comma between the number and the label: %s" % row[key['f']]))
+        # The custom types report their own problems, such as missing commas or a *_other field without an
+        # "other" choice. Unknown types are looked up without adding them to dispatch
+        try:
+            generated = (dispatch[kind] if kind in dispatch else dispatch.default_factory())(row)
+        except RepeatError, e:
+            issues.append((number, str(e)))
+            continue
+        except Exception, e:
+            issues.append((number, "Could not expand the %s field: %s" % (kind, e)))
+            continue
+        for line in generated:
+            lines.append((number, line))
+
+    # The group structure, worked out the same way find_groups does
+    names = Counter()
+    name_rows = defaultdict(list)
+    # (row number, logic, group number, source names of the group) for every row with logic. Rows outside
+    # groups have group number 0 and no source names.
+    logic = []
+    bounds = FieldBounds()
+    # The number of the first top-level group renaming each source field name. Logic in later groups that
+    # refers to the source name gets the name of the field's last iteration.
+    renamed = {}
+    group_number = 0
+    # (start row number, rows, [(row number, id) of nested counts], row numbers) for every group still open
+    open_groups = []
+    for number, line in lines:
+        cell = line[key['a']]
+        marker = classify(cell)
+        if marker.kind == "plain" and marker_re.match(cell):
+            issues.append((number, "'%s' is not a field name followed by a valid startrepeat, repeat or endrepeat" % cell))
+        if not open_groups and not marker.opens:
+            logic.append((number, line[key['l']], 0, ()))
+
+        if marker.opens:
+            count = marker.count
+            other_id_match = other_id_re.match(count)
+            if not count.isdigit() and not other_id_match:
+                issues.append((number, "Repeat count '%s' must be a number or [field]" % count))
+            elif other_id_match and open_groups:
+                open_groups[-1][2].append((number, other_id_match.group(1)))
+            elif other_id_match and bounds.get(other_id_match.group(1)) is None:
+                issues.append((number, "[%s] is not a field with a maximum before this group, it will repeat %d times"
+                        % (other_id_match.group(1), options.max_repeat)))
+            open_groups.append((number, [], [], []))
+
+        if open_groups:
+            for group in open_groups:
+                group[1].append(line)
+                group[3].append(number)
+        else:
+            bounds.add(line)
+            names[marker.id] += 1
+            name_rows[marker.id].append(number)
+
+        if marker.closes:
+            if not open_groups:
+                issues.append((number, "endrepeat without a startrepeat"))
+                continue
+            start, group, nested, numbers = open_groups.pop()
+            group_bounds = FieldBounds(group)
+            for nested_number, other_id in nested:
+                if group_bounds.get(other_id) is None:
+                    issues.append((nested_number, "[%s] is not a field with a maximum in the enclosing group, it will"
+                            " repeat %d times" % (other_id, options.max_repeat)))
+            if not open_groups:
+                # A complete top-level group, the names it generates count towards duplicates and logic. Logic
+                # inside the group can also use the names of its own fields before expansion
+                group_number += 1
+                group_logic(logic, group, numbers, group_number)
+                try:
+                    plan = GroupPlan(group, expander)
+                    fields = list(plan.lineage([], (), (), bounds))
+                except (RepeatError, AttributeError, IndexError, ValueError):
+                    # Already reported as a bad repeat count
+                    continue
+                for field in fields:
+                    names[field[0]] += 1
+                    name_rows[field[0]].append(start)
+                for cell in plan.renames(bounds):
+                    renamed.setdefault(cell, group_number)
+
+    for start, group, nested, numbers in open_groups:
+        issues.append((start, "startrepeat is never closed by an endrepeat, the rest of the dictionary is left out"))
+    if open_groups:
+        # The rest of the dictionary is in the group, so its logic can use the names of the group's fields
+        group_logic(logic, open_groups[0][1], open_groups[0][3], group_number + 1)
+
+    for name, count in names.items():
+        if count > 1:
+            rows = sorted(set(name_rows[name]))
+            issues.append((rows[0], "The field name %s is generated %d times (rows %s)" % (name, count,
+                    ", ".join(str(row) for row in rows))))
+
+    for number, text, group, cells in logic:
+        tokens = tokenize_logic(text)
+        for index in range(1, len(tokens), 2):
+            name = tokens[index]
+            # [event][field] and smart variables such as [record-name] aren't fields
+            if index + 2 < len(tokens) and tokens[index + 1] == "]":
+                continue
+            if "-" in name or ":" in name or name in names or name in cells:
+                continue
+            if group and renamed.get(name, group) < group:
+                continue
+            issues.append((number, "Branching logic refers to [%s], which is not a field" % name))
+
+    # A custom type can copy the same logic onto several rows
+    seen = set()
+    unique = []
+    for issue in issues:
+        if issue not in seen:
+            seen.add(issue)
+            unique.append(issue)
+    unique.sort(key=lambda issue: issue[0])
+    return unique
+
+def check_file(input_file, expander):
+    """Prints every issue check() finds. Returns the number found."""
+    handle_in = open_input(input_file)
+    try:
+        issues = check(read_rows(handle_in), expander)
+    finally:
+        if handle_in is not sys.stdin:
+            handle_in.close()
+    for number, message in issues:
+        print "row %d: %s" % (number, message)
+    print "%d issue%s found" % (len(issues), "" if len(issues) == 1 else "s")
+    return len(issues)
+
+
+def dry_run(input_file, expander):
+    """Prints the size the dictionary would expand to without writing it"""
+    handle_in = open_input(input_file)
+    try:
+        estimate = expander.estimate(read_rows(handle_in))
+    finally:
+        if handle_in is not sys.stdin:
+            handle_in.close()
+
+    print "%-60s %8s %10s %8s" % ("Group", "Times", "Rows", "Logic")
+    for group in estimate['groups']:
+        times = group['times'] if group['instrument'] is None else "instance"
+        print "%-60s %8s %10d %8d" % (group['field'], times, group['output_rows'], group['longest_logic'])
+    print
+    print "%-60s %10s" % ("Form", "Rows")
+    for form, rows in sorted(estimate['forms'].items()):
+        print "%-60s %10d" % (form, rows)
+    print
+    print "%d rows in total, the longest branching logic is %d characters" % (estimate['output_rows'], estimate['longest_logic'])
+    return estimate
+
+def batch_pairs(args):
+    """Works out the (input, output) pairs for a batch run. args is either a manifest file with one
+    input,output pair per line or an input directory and an output directory, in which case every
+    .csv file in the input directory is expanded into a file of the same name in the output directory"""
+    if len(args) == 1:
+        handle = open(args[0], 'rU')
+        try:
+            pairs = [(row[0].strip(), row[1].strip()) for row in csv.reader(handle) if len(row) >= 2 and row[0].strip()]
+        finally:
+            handle.close()
+    else:
+        input_dir, output_dir = args
+        # Each output would be truncated before its input is read
+        if os.path.realpath(input_dir) == os.path.realpath(output_dir):
+            raise RepeatError("The output directory can't be the input directory, the dictionaries in it would be"
+                " overwritten before they are read.")
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        pairs = [(os.path.join(input_dir, name), os.path.join(output_dir, name))
+                for name in sorted(os.listdir(input_dir)) if name.lower().endswith(".csv")]
+    inputs = set(os.path.realpath(input_file) for input_file, output_file in pairs)
+    for input_file, output_file in pairs:
+        if os.path.realpath(output_file) in inputs:
+            raise RepeatError("%s is both an input and an output of the batch, it would be overwritten before it is"
+                " read." % output_file)
+    return pairs
+
+def batch_worker(job):
+    """Expands a single file of a batch, returns (input, output, error message or None, seconds taken)"""
+    input_file, output_file, expander = job
+    started = time.time()
+    try:
+        main(input_file, output_file, expander)
+    except (Exception, SystemExit), e:
+        # Don't leave a half written dictionary behind
+        if os.path.isfile(output_file):
+            os.remove(output_file)
+        return input_file, output_file, str(e) or e.__class__.__name__, time.time() - started
+    return input_file, output_file, None, time.time() - started
+
+def batch(pairs, jobs=None, expander=None):
+    """Expands every (input, output) pair across a pool of worker processes and prints a summary.
+    A file that fails is reported and the rest of the batch carries on. Returns the number of failures."""
+    if expander is None:
+        expander = Expander(options)
+    work = [(input_file, output_file, expander) for input_file, output_file in pairs]
+    if jobs == 1 or len(pairs) <= 1:
+        results = itertools.imap(batch_worker, work)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(batch_worker, work)
+
+    failures = 0
+    try:
+        for input_file, output_file, error, elapsed in results:
+            if error is None:
+                print "ok      %s -> %s (%.2fs)" % (input_file, output_file, elapsed)
+            else:
+                failures += 1
+                print "FAILED  %s: %s" % (input_file, error)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print "%d of %d files expanded, %d failed" % (len(pairs) - failures, len(pairs), failures)
+    return failures
+
+
+class RedcapApi(object):
+    """Talks to REDCap APIs. Each thread keeps a connection open to every server it has used and sends all its
+    requests for that server over it. Requests that fail because of the network, a server error or too many
+    requests are retried up to retries times, waiting backoff seconds and twice as long after each try."""
+
+    def __init__(self, retries=3, backoff=1.0, timeout=120):
+        import threading
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self, url):
+        import httplib
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        key = (url.scheme, url.netloc)
+        connection = connections.get(key)
+        if connection is None:
+            kind = httplib.HTTPSConnection if url.scheme == "https" else httplib.HTTPConnection
+            connection = connections[key] = kind(url.netloc, timeout=self.timeout)
+        return connection
+
+    def drop(self, url):
+        connection = getattr(self.local, 'connections', {}).pop((url.scheme, url.netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def post(self, api_url, fields):
+        """Sends fields as a form and returns the body of the response"""
+        import httplib
+        import socket
+        import urllib
+        import urlparse
+        url = urlparse.urlsplit(api_url)
+        path = url.path or "/"
+        body = urllib.urlencode(fields)
+        headers = {"Content-Type": "application/x-www-form-urlencoded", "Accept": "application/json"}
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                connection = self.connection(url)
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                # The server may have closed a connection that was kept open, start a new one
+                self.drop(url)
+                error = str(e) or e.__class__.__name__
+                continue
+            if response.status < 300:
+                return data
+            error = "%d %s" % (response.status, data[:200])
+            if response.status < 500 and response.status != 429:
+                raise RepeatError("REDCap at %s refused the request: %s" % (api_url, error))
+        raise RepeatError("REDCap at %s failed %d times, the last time with: %s" % (api_url, self.retries + 1, error))
+
+    def export_metadata(self, api_url, token):
+        """The project's data dictionary as rows, the header first, just as read from a csv file"""
+        try:
+            fields = json.loads(self.post(api_url, {"token": token, "content": "metadata", "format": "json",
+                    "returnFormat": "json"}))
+        except ValueError, e:
+            raise RepeatError("REDCap at %s did not send back JSON metadata: %s" % (api_url, e))
+        return [metadata_fields[:]] + [[unicode(field.get(name, "")).encode("utf-8") for name in metadata_fields]
+                for field in fields]
+
+    def import_metadata(self, api_url, token, data):
+        return self.post(api_url, {"token": token, "content": "metadata", "format": "json", "data": data,
+                "returnFormat": "json"})
+
+    def import_repeating_instruments(self, api_url, token, instruments):
+        data = json.dumps([{"form_name": name, "custom_form_label": label} for name, label in instruments])
+        return self.post(api_url, {"token": token, "content": "repeatingFormsEvents", "format": "json", "data": data,
+                "returnFormat": "json"})
+
+def api_projects(manifest):
+    """Reads the projects of an --api run, one url,source token,target token per line. Returns (line number, url,
+    source token, target token) for each."""
+    handle = open(manifest, 'rU')
+    try:
+        projects = []
+        for number, row in enumerate(csv.reader(handle), 1):
+            row = [cell.strip() for cell in row]
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+            if len(row) < 3:
+                raise RepeatError("Line %d of %s needs the API url, the source token and the target token"
+                        % (number, manifest))
+            projects.append((number, row[0], row[1], row[2]))
+        return projects
+    finally:
+        handle.close()
+
+def api_worker(job):
+    """Pulls one project's dictionary, expands it in memory and pushes it to the target project. Returns the
+    project's line number and url, an error message or None, the number of fields pushed and the time taken."""
+    api, expander, (number, url, source, target) = job
+    started = time.time()
+    try:
+        from StringIO import StringIO
+        rows = api.export_metadata(url, source)
+        handle = StringIO()
+        writer = MetadataWriter(handle)
+        instruments = []
+        for row in expander.expand_rows(rows, instruments=lambda name, label: instruments.append((name, label))):
+            writer.write(row)
+        writer.close()
+        api.import_metadata(url, target, handle.getvalue())
+        if instruments:
+            api.import_repeating_instruments(url, target, instruments)
+    except Exception, e:
+        return number, url, str(e) or e.__class__.__name__, 0, time.time() - started
+    return number, url, None, writer.rows - 1, time.time() - started
+
+def api_batch(projects, jobs=None, expander=None, api=None):
+    """Runs api_worker for every project, up to jobs (default 4) at a time, and prints a summary. A project that
+    fails is reported and the rest carry on. Returns the number of failures."""
+    if expander is None:
+        expander = Expander(options)
+    if api is None:
+        api = RedcapApi()
+    work = [(api, expander, project) for project in projects]
+    # The work is waiting on the network, so threads are enough, and they share the Expander and connections
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs or 4, max(len(projects), 1)))
+    failures = 0
+    try:
+        for number, url, error, fields, elapsed in pool.imap(api_worker, work):
+            if error is None:
+                print "ok      line %d %s: %d fields (%.2fs)" % (number, url, fields, elapsed)
+            else:
+                failures += 1
+                print "FAILED  line %d %s: %s" % (number, url, error)
+    finally:
+        pool.close()
+        pool.join()
+    print "%d of %d projects expanded, %d failed" % (len(projects) - failures, len(projects), failures)
+    return failures
+
+
+class RequestOptions(object):
+    """The options of one service request. Anything the request doesn't set is taken from base."""
+
+    names = ("auto", "prompt", "validation_off", "groups", "max_repeat", "simplify_logic", "plurals", "group_jobs",
+            "max_fields", "native")
+    # What a request may set each option to. plurals and group_jobs stay as the server was started, as one
+    # would read any file on the server and the other start worker processes for every request.
+    settable = {"auto": "flag", "prompt": "flag", "validation_off": "flag", "simplify_logic": "flag",
+            "native": "flag", "max_repeat": "count", "max_fields": "count or null", "groups": "text or null"}
+    kinds = {"flag": "true or false", "count": "a whole number above 0",
+            "count or null": "a whole number above 0 or null", "text or null": "a string or null"}
+
+    def __init__(self, base, overrides):
+        for name in self.names:
+            setattr(self, name, getattr(base, name))
+        for name, value in overrides.items():
+            if name not in self.settable:
+                raise RepeatError("Unknown option '%s', the options a request can set are %s"
+                        % (name, ", ".join(sorted(self.settable))))
+            setattr(self, name, self.value(name, value))
+        if self.auto and self.prompt:
+            raise RepeatError("The auto and prompt options are mutually exclusive")
+
+    def value(self, name, value):
+        kind = self.settable[name]
+        if value is None and kind.endswith("or null"):
+            return None
+        if kind == "flag" and isinstance(value, bool):
+            return value
+        if kind.startswith("count") and isinstance(value, (int, long)) and not isinstance(value, bool) and value > 0:
+            return value
+        if kind.startswith("text") and isinstance(value, basestring):
+            return value.encode("utf-8") if isinstance(value, unicode) else value
+        raise RepeatError("The %s option must be %s, not %s" % (name, self.kinds[kind], json.dumps(value)))
+
+    def settings(self):
+        return tuple(getattr(self, name) for name in self.names)
+
+class Service(object):
+    """Expands dictionaries sent to it one request after another, without paying for startup each time. An
+    Expander is kept for every set of options asked for, so the plurals file is read and each group name
+    pluralized only once. A request is a JSON object with either "rows" (a list of rows, the header first) or
+    "csv" (the text of a dictionary), optionally "options" overriding some of the command line ones (see
+    RequestOptions.settable), and an "id" that is sent back. With "group" set, the rows are a single top-level
+    group (no header) and "bounds" can give the maximum of the fields its [field] count refers to. The response
+    has the expanded "rows", or an "error" if the request could not be expanded. Only the max_expanders most
+    recently used Expanders are kept."""
+
+    max_expanders = 16
+
+    def __init__(self, options, cache=None):
+        import threading
+        from collections import OrderedDict
+        self.options = options
+        self.cache = cache
+        self.expanders = OrderedDict()
+        self.lock = threading.Lock()
+
+    def expander(self, overrides):
+        options = RequestOptions(self.options, overrides or {})
+        settings = options.settings()
+        with self.lock:
+            expander = self.expanders.pop(settings, None)
+            if expander is None:
+                expander = Expander(options, cache=self.cache)
+                if len(self.expanders) >= self.max_expanders:
+                    self.expanders.popitem(last=False)
+            # The most recently used last
+            self.expanders[settings] = expander
+        return expander
+
+    def expand(self, request, instruments=None):
+        expander = self.expander(request.get("options"))
+        if "rows" in request:
+            rows = [[unicode(cell).encode("utf-8") for cell in row] for row in request["rows"]]
+        elif "csv" in request:
+            from StringIO import StringIO
+            # Quoted cells, such as labels and choices, can have line breaks in them
+            rows = list(csv.reader(StringIO(request["csv"].encode("utf-8"))))
+        else:
+            raise RepeatError("The request needs the dictionary as either rows or csv")
+        if not request.get("group"):
+            return expander.expand_rows(rows, instruments=instruments)
+
+        groups = list(find_groups(preprocess(rows)))
+        if len(groups) != 1 or not groups[0][0]:
+            raise RepeatError("The rows are not a single top-level repeating group")
+        bounds = FieldBounds()
+        for name, maximum in (request.get("bounds") or {}).items():
+            bounds.bounds[name.encode("utf-8")] = int(maximum)
+        return expander.expand_group(groups[0][1], bounds)
+
+    def handle(self, request):
+        """Returns the response to one request. Nothing a request does is seen by the next one, other than
+        the warmed up Expanders."""
+        response = {}
+        try:
+            if not isinstance(request, dict):
+                raise RepeatError("A request must be a JSON object")
+            response["id"] = request.get("id")
+            started = time.time()
+            made = []
+            response["rows"] = [row if type(row) is list else row.to_list()
+                    for row in self.expand(request, lambda name, label: made.append([name, label]))]
+            if made:
+                response["repeating_instruments"] = made
+            response["seconds"] = round(time.time() - started, 4)
+        except RepeatError, e:
+            response["error"] = str(e)
+        except Exception, e:
+            logger.debug("Request failed", exc_info=True)
+            response["error"] = "%s: %s" % (e.__class__.__name__, e)
+        return response
+
+    def serve_lines(self, handle_in, handle_out):
+        """Reads a JSON request per line and writes a JSON response per line, until handle_in is closed"""
+        for line in iter(handle_in.readline, ""):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError, e:
+                response = {"error": "The request is not valid JSON: %s" % e}
+            else:
+                response = self.handle(request)
+            handle_out.write(json.dumps(response) + "\n")
+            handle_out.flush()
+
+    def serve_http(self, port, host="127.0.0.1"):
+        """Answers requests POSTed to any path, each in its own thread"""
+        import BaseHTTPServer
+        import SocketServer
+        service = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.getheader("content-length") or 0)))
+                except ValueError, e:
+                    response = {"error": "The request is not valid JSON: %s" % e}
+                else:
+                    response = service.handle(request)
+                body = json.dumps(response)
+                self.send_response(400 if "error" in response else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        server = Server((host, port), Handler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
 
 
 if __name__ == "__main__":
@@ -781,18 +2762,184 @@ if __name__ == "__main__":
             help="The name you would like to use for groups in generated questions. For example, if set to 'items', a generated questions would be: 'How many medication"
             "items would you like to enter?' By default, if this is not specified repeat group name would be pluralized, and the sentence would be 'How many medications would you like to enter?'")
     parser.add_option("-d", "--debug", dest="debug", default=False, action="store_true", help = "Print debug statements. Useful for determine what groups and nested groups have been found.")
-    parser.add_option("-m", "--max_repeat", default=10, dest="max_repeat", action="store",
+    parser.add_option("-m", "--max_repeat", default=10, dest="max_repeat", action="store", type="int",
             help="The maximum number of repeating groups to use in situations where it is not defined.")
+    parser.add_option("--max_fields", default=None, dest="max_fields", action="store", type="int",
+            help="The most fields to put on one form. Once a form is full, the rest of its fields go on form_2, form_3 and so"
+            " on. Repeating groups are only split between iterations.")
+    parser.add_option("--native", default=False, dest="native", action="store_true",
+            help="Put each top-level repeating group on a REDCap repeating instrument of its own, with its fields written once,"
+            " instead of copying them for every iteration. Groups with nested groups or a [field] count are expanded as usual.")
+    parser.add_option("--repeating_instruments", default=None, dest="repeating_instruments", action="store",
+            help="With --native, write the repeating instruments to this csv file, to import into REDCap along with the"
+            " dictionary.")
     parser.add_option("-v", "--validation_off", default=False, dest="validation_off", action="store_true",
             help="Disable use of REDCap input validation")
+    parser.add_option("--simplify_logic", default=False, dest="simplify_logic", action="store_true",
+            help="Shorten the generated branching logic by removing redundant parentheses, repeated conditions and comparisons"
+            " implied by another one, so that REDCap evaluates it faster.")
+    parser.add_option("--plurals", default=None, dest="plurals", action="store",
+            help="A JSON file mapping lower case group names to their plural, for names the script pluralizes wrongly.")
+    parser.add_option("-l", "--lineage", default=None, dest="lineage", action="store",
+            help="Also write a csv to this file mapping every generated field to its source field, the repeating groups it is"
+            " in and its iteration in each. reshape.py uses it to turn wide record exports into long tables.")
+    parser.add_option("--metadata", default=None, dest="metadata", action="store",
+            help="Also write the expanded dictionary to this file as JSON, in the form REDCap's API takes to import"
+            " metadata. With --metadata or --lineage the csv output file can be left off.")
+    parser.add_option("-b", "--batch", default=False, dest="batch", action="store_true",
+            help="Expand many dictionaries at once. Pass either a manifest file with one 'input,output' pair per line, or an input directory"
+            " and an output directory.")
+    parser.add_option("-j", "--jobs", default=None, dest="jobs", action="store", type="int",
+            help="The number of worker processes used by --batch, defaults to the number of CPUs, or the number of projects"
+            " --api works on at once, defaults to 4.")
+    parser.add_option("--api", default=False, dest="api", action="store_true",
+            help="Pull the data dictionaries of REDCap projects through the API, expand them and push them to other projects."
+            " Pass a file with one 'API url,source token,target token' line per project.")
+    parser.add_option("--retries", default=3, dest="retries", action="store", type="int",
+            help="How many times --api tries a request again after a network or server error.")
+    parser.add_option("--group_jobs", default=None, dest="group_jobs", action="store", type="int",
+            help="Expand the top-level repeating groups of a dictionary across this many worker processes. The output is the"
+            " same as expanding them one after the other.")
+    parser.add_option("-c", "--cache", default=None, dest="cache", action="store",
+            help="A directory to cache expanded repeating groups in. Groups that have not changed since the last run are read from"
+            " the cache instead of being expanded again.")
+    parser.add_option("--cache_size", default=1000, dest="cache_size", action="store", type="int",
+            help="The maximum number of groups kept in the cache, the least recently used are removed first.")
+    parser.add_option("--clear_cache", default=False, dest="clear_cache", action="store_true",
+            help="Empty the --cache directory before running. With no files given, just empty it.")
+    parser.add_option("-s", "--stats", default=None, dest="stats", action="store",
+            help="Write a JSON report to this file with the time spent preprocessing custom types and expanding groups, and for each"
+            " repeating group how many times it repeats, its depth, input and output rows, longest branching logic and time taken.")
+    parser.add_option("-k", "--check", default=False, dest="check", action="store_true",
+            help="Don't expand anything, just list every problem found in the input with its row number: unbalanced repeat"
+            " markers, bad repeat counts, custom types that can't be expanded, branching logic that refers to fields that don't"
+            " exist and field names that would be generated more than once.")
+    parser.add_option("-n", "--dry_run", default=False, dest="dry_run", action="store_true",
+            help="Don't write anything, just print how many rows each repeating group and each form would expand to and the"
+            " length of the longest branching logic. The output file can be left off.")
+    parser.add_option("--serve", default=False, dest="serve", action="store_true",
+            help="Keep running and expand the dictionaries sent as requests, one JSON object per line on stdin with a JSON"
+            " response per line on stdout. See the Service class for what goes in a request.")
+    parser.add_option("--port", default=None, dest="port", action="store", type="int",
+            help="With --serve, take the requests as HTTP POSTs on this port of localhost instead of stdin.")
+    parser.add_option("--profile", default=None, dest="profile", action="store",
+            help="Run under cProfile and save the profile to this file, for use with python -m pstats.")
     (options, args) = parser.parse_args()
 
     if options.auto and options.prompt:
-        print "--prompt_add and --auto_add are mutually exclusive. Please choose one. See --help for more details."
-        sys.exit()
+        parser.error("--prompt_add and --auto_add are mutually exclusive. Please choose one.")
     if options.debug:
         logger.setLevel(logging.DEBUG)
 
-    main(args[0], args[1])
+    cache = None
+    if options.cache:
+        cache = GroupCache(options.cache, options.cache_size)
+        if options.clear_cache:
+            cache.clear()
+            if not args:
+                sys.exit()
+    elif options.clear_cache:
+        parser.error("--clear_cache needs the --cache directory to empty")
+    expander = Expander(options, cache=cache)
+
+    if options.batch:
+        if options.group_jobs > 1:
+            parser.error("--group_jobs can't be used with --batch, which already expands files in parallel")
+        if len(args) not in (1, 2):
+            parser.error("--batch takes a manifest file or an input and an output directory")
+        try:
+            pairs = batch_pairs(args)
+        except RepeatError, e:
+            parser.error(str(e))
+        if batch(pairs, options.jobs, expander):
+            sys.exit(1)
+        sys.exit()
+
+    if options.api:
+        if options.group_jobs > 1:
+            parser.error("--group_jobs can't be used with --api, which already runs projects in parallel")
+        if len(args) != 1:
+            parser.error("--api takes a file with one 'url,source token,target token' line per project")
+        try:
+            projects = api_projects(args[0])
+        except RepeatError, e:
+            parser.error(str(e))
+        if api_batch(projects, options.jobs, expander, RedcapApi(options.retries)):
+            sys.exit(1)
+        sys.exit()
+
+    if options.serve:
+        service = Service(options, cache)
+        try:
+            if options.port:
+                service.serve_http(options.port)
+            else:
+                service.serve_lines(sys.stdin, sys.stdout)
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+    elif options.port:
+        parser.error("--port is only used with --serve")
+
+    if options.check:
+        if len(args) < 1:
+            parser.error("--check needs an input file")
+        if check_file(args[0], expander):
+            sys.exit(1)
+        sys.exit()
+
+    if options.dry_run:
+        if len(args) < 1:
+            parser.error("--dry_run needs an input file")
+        try:
+            dry_run(args[0], expander)
+        except RepeatError, e:
+            sys.stderr.write("%s\n" % e)
+            sys.exit(1)
+        sys.exit()
+
+    # Every output is written from the one expansion
+    handles = []
+    writers = []
+    if options.metadata:
+        handles.append(open_output(options.metadata))
+        writers.append(MetadataWriter(handles[-1]))
+    if options.lineage:
+        handles.append(open_output(options.lineage))
+        writers.append(LineageWriter(handles[-1]))
+    if options.repeating_instruments:
+        if not options.native:
+            parser.error("--repeating_instruments needs --native")
+        handles.append(open_output(options.repeating_instruments))
+        writers.append(RepeatingInstrumentsWriter(handles[-1]))
+    if len(args) < 1 or (len(args) < 2 and not writers):
+        parser.error("pass an input and an output file")
+    output_file = args[1] if len(args) > 1 else None
+    if output_file not in (None, "-") and os.path.realpath(output_file) == os.path.realpath(args[0]):
+        parser.error("the output file can't be the input file, it would be overwritten before it is read")
+
+    stats = RunStats() if options.stats else None
+    try:
+        try:
+            if options.profile:
+                import cProfile
+                cProfile.run("main(args[0], output_file, expander, stats, writers)", options.profile)
+            else:
+                main(args[0], output_file, expander, stats, writers)
+        finally:
+            for handle in handles:
+                if handle is not sys.stdout:
+                    handle.close()
+        if stats is not None:
+            stats_file = open(options.stats, 'w')
+            json.dump(stats.report(expander), stats_file, indent=2)
+            stats_file.close()
+    except RepeatError, e:
+        sys.stderr.write("%s\n" % e)
+        # Don't leave half written outputs behind
+        for name in [output_file, options.metadata, options.lineage, options.repeating_instruments]:
+            if name not in (None, "-") and os.path.isfile(name):
+                os.remove(name)
+        sys.exit(1)
 else:
     options = FakeOptions()
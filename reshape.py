@@ -0,0 +1,217 @@
+#!/bin/python
+#Copyright (c) 2012, The Children's Hospital of Philadelphia All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+#following conditions are met:
+#
+#1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+#   disclaimer.
+#
+#2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+#INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+#SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+#WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+#USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+# Turns a wide REDCap record export (med_name1 ... med_name50, visit2_lab_value3, ...) of a dictionary expanded
+# by redcap_repeat into one long table per repeating group, with a row per record and iteration. It needs the
+# lineage file written by redcap_repeat.py --lineage.
+#
+#   python redcap_repeat.py --lineage lineage.csv dictionary.csv expanded.csv
+#   python reshape.py lineage.csv export.csv tables/
+#
+# The export is read one record at a time, so memory use does not grow with its size.
+
+import os
+import csv
+import sys
+from optparse import OptionParser
+
+# Columns REDCap adds to exports that say which row a record's values belong to
+key_columns = ["redcap_event_name", "redcap_repeat_instrument", "redcap_repeat_instance", "redcap_data_access_group"]
+
+
+def read_lineage(handle):
+    """Reads a lineage csv into {generated field name: (source field, group path, iterations)}. Only the
+    group's own fields are kept, not the generated count questions and "add another" checkboxes."""
+    lineage = {}
+    reader = csv.reader(handle)
+    header = next(reader)
+    columns = dict((name, index) for index, name in enumerate(header))
+    for row in reader:
+        if row[columns['kind']] != "field":
+            continue
+        groups = tuple(row[columns['group_path']].split("/"))
+        iterations = tuple(int(i) for i in row[columns['iterations']].split("."))
+        lineage[row[columns['field_name']]] = (row[columns['source_field']], groups, iterations)
+    return lineage
+
+
+class Table(object):
+    """The long table of one repeating group. Its columns are the source fields of the group, each instance
+    lists the export columns (and where they go) for one combination of iterations."""
+
+    def __init__(self, groups):
+        self.groups = groups
+        # A column per level of nesting for the iteration, named after the group (and the level, if a group
+        # is nested in one of the same name)
+        self.iteration_columns = [name if list(groups).count(name) == 1 else "%s_%d" % (name, level + 1)
+                for level, name in enumerate(groups)]
+        self.columns = []
+        self.positions = {}
+        self.instances = []
+        self.cells = {}
+
+    def name_iterations(self, taken):
+        """Adds _instance to the name of any iteration column that would have the same name as one of taken or
+        a source field column, e.g. for a group called visit that has a visit field"""
+        taken = set(taken) | set(self.columns)
+        names = []
+        for name in self.iteration_columns:
+            while name in taken:
+                name += "_instance"
+            taken.add(name)
+            names.append(name)
+        self.iteration_columns = names
+
+    def add(self, index, column, iterations):
+        position = self.positions.get(column)
+        if position is None:
+            position = self.positions[column] = len(self.columns)
+            self.columns.append(column)
+        cells = self.cells.get(iterations)
+        if cells is None:
+            cells = self.cells[iterations] = []
+            self.instances.append((iterations, cells))
+        cells.append((index, position))
+
+    def file_name(self):
+        return ".".join(self.groups) + ".csv"
+
+
+class Reshaper(object):
+    """Works out from the header of an export where each of its columns goes, then splits each record row
+    into rows of the group tables. Columns that are not part of a repeating group are left out. Unless
+    keep_empty is set, instances with no values at all are skipped."""
+
+    def __init__(self, header, lineage, keep_empty=False):
+        self.keep_empty = keep_empty
+        # The record id is always the first column
+        self.keys = [0] + [index for index, name in enumerate(header) if name in key_columns]
+        self.key_names = [header[index] for index in self.keys]
+        self.tables = []
+        tables = {}
+        for index, name in enumerate(header):
+            suffix = ""
+            if name not in lineage and "___" in name:
+                # A checkbox is exported as one column per choice, field___code
+                name, code = name.rsplit("___", 1)
+                suffix = "___" + code
+            if name not in lineage:
+                continue
+            source, groups, iterations = lineage[name]
+            table = tables.get(groups)
+            if table is None:
+                table = tables[groups] = Table(groups)
+                self.tables.append(table)
+            table.add(index, source + suffix, iterations)
+        for table in self.tables:
+            table.name_iterations(self.key_names)
+
+    def header(self, table):
+        return self.key_names + table.iteration_columns + table.columns
+
+    def rows(self, row):
+        """Yields (table, row) for every instance of every group in one record row of the export"""
+        keys = [row[index] for index in self.keys]
+        width = len(row)
+        for table in self.tables:
+            for iterations, cells in table.instances:
+                values = [""] * len(table.columns)
+                empty = True
+                for index, position in cells:
+                    if index < width and row[index] != "":
+                        values[position] = row[index]
+                        empty = False
+                if empty and not self.keep_empty:
+                    continue
+                yield table, keys + list(iterations) + values
+
+    def reshape(self, rows):
+        """Yields (table, row) for every record row"""
+        for row in rows:
+            for result in self.rows(row):
+                yield result
+
+    def chunks(self, rows, size=10000):
+        """Yields {table: {column: [values]}} for every `size` record rows, for loading the tables a chunk at a
+        time into column oriented tools"""
+        chunk = {}
+        count = 0
+        for row in rows:
+            for table, values in self.rows(row):
+                columns = chunk.get(table)
+                if columns is None:
+                    columns = chunk[table] = dict((name, []) for name in self.header(table))
+                for name, value in zip(self.header(table), values):
+                    columns[name].append(value)
+            count += 1
+            if count == size:
+                yield chunk
+                chunk = {}
+                count = 0
+        if chunk:
+            yield chunk
+
+
+def reshape(lineage_file, export_file, output_dir, keep_empty=False):
+    """Writes a csv per repeating group to output_dir. Returns the number of rows written to each file."""
+    handle = open(lineage_file, 'rU')
+    try:
+        lineage = read_lineage(handle)
+    finally:
+        handle.close()
+
+    handle_in = sys.stdin if export_file == "-" else open(export_file, 'rU')
+    reader = csv.reader(handle_in)
+    reshaper = Reshaper(next(reader), lineage, keep_empty)
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    handles = {}
+    writers = {}
+    counts = {}
+    try:
+        for table in reshaper.tables:
+            handles[table] = open(os.path.join(output_dir, table.file_name()), 'wb')
+            writers[table] = csv.writer(handles[table])
+            writers[table].writerow(reshaper.header(table))
+            counts[table.file_name()] = 0
+        for table, row in reshaper.reshape(reader):
+            writers[table].writerow(row)
+            counts[table.file_name()] += 1
+    finally:
+        for handle in handles.values():
+            handle.close()
+        if handle_in is not sys.stdin:
+            handle_in.close()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] lineage.csv export.csv output_directory")
+    parser.add_option("-e", "--keep_empty", default=False, dest="keep_empty", action="store_true",
+            help="Write a row for every record and iteration, even if none of its fields have a value.")
+    (options, args) = parser.parse_args()
+    if len(args) != 3:
+        parser.error("pass the lineage file, the record export (- for stdin) and a directory to write the tables to")
+
+    counts = reshape(args[0], args[1], args[2], options.keep_empty)
+    for name, rows in sorted(counts.items()):
+        print "%-60s %10d rows" % (name, rows)
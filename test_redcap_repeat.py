@@ -0,0 +1,654 @@
+"""Tests for redcap_repeat.py. Run with python -m unittest test_redcap_repeat"""
+import BaseHTTPServer
+import csv
+import json
+import os
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+from collections import OrderedDict
+from StringIO import StringIO
+
+import redcap_repeat
+import reshape
+from redcap_repeat import Expander, GroupCache, RedcapApi, RepeatError
+
+
+def row(field, form="form_a", kind="text", label="", logic=""):
+    line = [""] * 16
+    line[redcap_repeat.key['a']] = field
+    line[redcap_repeat.key['b']] = form
+    line[redcap_repeat.key['d']] = kind
+    line[redcap_repeat.key['e']] = label
+    line[redcap_repeat.key['l']] = logic
+    return line
+
+def options(**settings):
+    fake = redcap_repeat.FakeOptions()
+    fake.prompt = False
+    for name, value in settings.items():
+        setattr(fake, name, value)
+    return fake
+
+def expand(rows, expander):
+    return dict((line[redcap_repeat.key['a']], line[redcap_repeat.key['l']]) for line in expander.expand(rows))
+
+# The second group refers to fields of the first one
+cross_group = [
+    row("med startrepeat 4 Medication", label="Medication"),
+    row("last endrepeat", label="Last dose"),
+    row("visit startrepeat 2 Visit", label="Visit", logic="[last] = '1'"),
+    row("dose endrepeat", label="Dose", logic="[med] <> '' and [visit] <> ''"),
+    row("notes", label="Notes"),
+]
+
+
+class CrossGroupRenamesTest(unittest.TestCase):
+    """Logic in a later group that refers to a field of an earlier group gets the name of its last iteration"""
+
+    def check(self, expander):
+        logic = expand(cross_group, expander)
+        self.assertEqual(logic["visit1"], "([last4] = '1') and [visit_group_no]>=1")
+        self.assertEqual(logic["dose2"], "([med4] <> '' and [visit2] <> '') and [visit_group_no]>=2")
+        self.assertEqual(logic["visit_group_no"], "[last4] = '1'")
+
+    def test_serial(self):
+        self.check(Expander(options()))
+
+    def test_parallel(self):
+        self.check(Expander(options(group_jobs=2)))
+
+    def test_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.check(Expander(options(), cache=GroupCache(directory)))
+            cache = GroupCache(directory)
+            self.check(Expander(options(), cache=cache))
+            self.assertEqual((cache.hits, cache.misses), (2, 0))
+            # The same second group after a first group that repeats a different number of times is a new entry
+            rows = [row("med startrepeat 3 Medication", label="Medication")] + cross_group[1:]
+            logic = expand(rows, Expander(options(), cache=cache))
+            self.assertEqual(logic["visit_group_no"], "[last3] = '1'")
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dry_run(self):
+        estimate = Expander(options()).estimate(cross_group)
+        self.assertEqual(estimate['longest_logic'], len("([med4] <> '' and [visit2] <> '') and [visit_group_no]>=2"))
+
+
+class ExpanderTest(unittest.TestCase):
+
+    def test_rows_are_lists(self):
+        rows = list(Expander(options()).expand([row("field")] + cross_group))
+        self.assertEqual(set(type(line) for line in rows), set([list]))
+        self.assertEqual(redcap_repeat.repeat_group(cross_group[:2], expander=Expander(options()))[1][0], "med1")
+
+    def test_expanded_rows_act_like_lists(self):
+        skeleton = row("med", label="Medication")
+        skeleton[redcap_repeat.key['p']] = "mx"
+        expanded = redcap_repeat.ExpandedRow(skeleton, "med1", "Medication 1", "[n]>=1", "mx1")
+        cells = expanded.to_list()
+        for index in range(-len(cells), len(cells)):
+            self.assertEqual(expanded[index], cells[index], index)
+        self.assertEqual(expanded[-1], "mx1")
+        self.assertEqual(expanded[2:], cells[2:])
+        self.assertTrue(expanded == cells and expanded == tuple(cells) and cells == expanded)
+        self.assertTrue(expanded == redcap_repeat.ExpandedRow(skeleton, "med1", "Medication 1", "[n]>=1", "mx1"))
+        self.assertFalse(expanded == None)
+        self.assertTrue(expanded != None and expanded != 1 and expanded != skeleton)
+
+    def test_counters_are_per_expander(self):
+        rows = [row("med${d}_x startrepeat 3 Medication", label="Medication $d"), row("last endrepeat")]
+        first, second = Expander(options()), Expander(options())
+        list(first.expand(rows))
+        stats = redcap_repeat.RunStats()
+        list(second.expand(rows, stats))
+        list(second.expand(rows, stats))
+        hits, misses = first.templates.hits, first.templates.misses
+        self.assertTrue(misses > 0)
+        # The second run only finds what the first one parsed, and the first Expander sees none of it
+        self.assertEqual(stats.report(second)['template_cache'], {'hits': 2 * hits + misses, 'misses': misses})
+        self.assertEqual((first.templates.hits, first.templates.misses), (hits, misses))
+
+    def test_parallel_buffer_is_bounded(self):
+        rows = cross_group[:2] + [row("plain%d" % number) for number in range(50)]
+        read = []
+
+        def source():
+            for line in rows:
+                read.append(line)
+                yield line
+        lags = []
+        for line in redcap_repeat.expand_groups_parallel(source(), Expander(options()), 1, max_buffered=5):
+            lags.append(len(read))
+        # Nothing comes out before the group is done, and by then no more than 5 rows have been read
+        self.assertTrue(lags[0] <= 5, lags[0])
+        self.assertEqual(len(lags), 9 + 50)
+
+    def test_dry_run_with_native_instruments(self):
+        rows = [row("field")] + cross_group
+        expander = Expander(options(native=True))
+        output = list(expander.expand(rows))
+        estimate = expander.estimate(rows)
+        self.assertEqual(estimate['output_rows'], len(output))
+        self.assertEqual(estimate['forms'], {"form_a": 2, "medication": 2, "visit": 2})
+        self.assertEqual([group['instrument'] for group in estimate['groups']], ["medication", "visit"])
+
+    def test_threads_share_an_expander(self):
+        def choice_row(field, kind, size):
+            line = row(field, kind=kind, label="Symptom | Symptoms")
+            options = ["%d, Option %d" % (code, code) for code in range(1, size)] + ["%d, None" % size]
+            line[redcap_repeat.key['f']] = " | ".join(options + ["%d, Other" % (size + 1)])
+            return line
+        rows = [row("field")]
+        for number in range(40):
+            kind = ["checkbox_mutex_other", "checkbox_mutex", "checkbox_details", "radio_other"][number % 4]
+            rows.append(choice_row("symptom%d" % number, kind, 2 + number))
+        rows += [choice_row("visit startrepeat 3 Visit", "checkbox_mutex_other", 5), choice_row("last endrepeat",
+            "checkbox_mutex", 30)]
+        expander = Expander(options())
+        redcap_repeat.choice_index.clear()
+        serial = list(expander.expand(rows))
+        redcap_repeat.choice_index.clear()
+        results, errors = [None] * 8, []
+
+        def run(slot):
+            try:
+                results[slot] = list(expander.expand(rows))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(slot,)) for slot in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(len(serial) > len(rows))
+        for result in results:
+            self.assertEqual(result, serial)
+
+
+def forms_of(rows):
+    """The form of each row, the header left out"""
+    return [line[redcap_repeat.key['b']] for line in rows][1:]
+
+def contiguous(forms):
+    """Whether the rows of each form are all together"""
+    seen = []
+    for form in forms:
+        if not seen or seen[-1] != form:
+            if form in seen:
+                return False
+            seen.append(form)
+    return True
+
+
+class FormSplitterTest(unittest.TestCase):
+
+    def split(self, rows, max_fields, **settings):
+        return forms_of(Expander(options(max_fields=max_fields, **settings)).expand([row("field", form="form")] + rows))
+
+    def test_form_under_the_limit(self):
+        rows = [row("a"), row("b"), row("c", form="form_b")]
+        self.assertEqual(self.split(rows, 3), ["form_a", "form_a", "form_b"])
+
+    def test_exact_multiple(self):
+        rows = [row("f%d" % number) for number in range(6)]
+        self.assertEqual(self.split(rows, 3), ["form_a"] * 3 + ["form_a_2"] * 3)
+
+    def test_group_moves_between_iterations(self):
+        # The count question and three iterations of two fields
+        rows = [row("plain"), row("a startrepeat 3 Item"), row("b endrepeat")]
+        self.assertEqual(self.split(rows, 4), ["form_a"] * 4 + ["form_a_2"] * 4)
+
+    def test_group_larger_than_max_fields(self):
+        # An iteration of four fields can't be split, so it gets a form of its own
+        rows = [row("a startrepeat 2 Item"), row("b"), row("c"), row("d endrepeat")]
+        self.assertEqual(self.split(rows, 3), ["form_a"] + ["form_a_2"] * 4 + ["form_a_3"] * 4)
+
+    def test_native_instruments_stay_between_forms(self):
+        rows = [row("p%d" % number) for number in range(5)] + [
+            row("med startrepeat 3 Medication"),
+            row("dose endrepeat"),
+        ] + [row("q%d" % number) for number in range(5)] + [row("r", form="form_b")]
+        forms = self.split(rows, 2, native=True)
+        self.assertTrue(contiguous(forms), forms)
+        self.assertEqual(forms.count("medication"), 2)
+        self.assertEqual(len(forms), 13)
+
+
+class LineageTest(unittest.TestCase):
+    """Expanding with a lineage file, then reshaping a record export of the expanded dictionary with it"""
+
+    # A visit group with a visit field, and a lab group with a lab field nested in it
+    dictionary = [
+        row("field", form="form"),
+        row("record_id"),
+        row("visit startrepeat 2 Visit"),
+        row("note"),
+        row("lab startrepeat 2 Lab"),
+        row("lab_value endrepeat"),
+        row(" endrepeat", kind=""),
+    ]
+
+    def expand(self):
+        output = StringIO()
+        lineage = StringIO()
+        handle_in = StringIO()
+        csv.writer(handle_in).writerows(self.dictionary)
+        handle_in.seek(0)
+        redcap_repeat.main(handle_in, output, Expander(options()), writers=[redcap_repeat.LineageWriter(lineage)])
+        fields = [line[0] for line in csv.reader(StringIO(output.getvalue()))][1:]
+        return fields, lineage.getvalue()
+
+    def test_lineage(self):
+        fields, lineage = self.expand()
+        rows = list(csv.reader(StringIO(lineage)))
+        self.assertEqual(rows[0], redcap_repeat.lineage_header)
+        by_name = dict((line[0], line) for line in rows[1:])
+        self.assertEqual(sorted(by_name), sorted(field for field in fields if field != "record_id"))
+        self.assertEqual(by_name["visit2"], ["visit2", "visit", "form_a", "field", "visit", "2"])
+        self.assertEqual(by_name["visit2_lab_value1"], ["visit2_lab_value1", "lab_value", "form_a", "field",
+                "visit/lab", "2.1"])
+        self.assertEqual(by_name["visit_group_no"][3], "count")
+
+    def test_round_trip(self):
+        fields, lineage = self.expand()
+        # Each cell of the record holds the name of its column
+        reshaper = reshape.Reshaper(fields, reshape.read_lineage(StringIO(lineage)))
+        tables = dict((".".join(table.groups), table) for table in reshaper.tables)
+        self.assertEqual(sorted(tables), ["visit", "visit.lab"])
+        # The iteration columns are renamed where a group has a field of the same name
+        self.assertEqual(reshaper.header(tables["visit"]), ["record_id", "visit_instance", "visit", "note"])
+        self.assertEqual(reshaper.header(tables["visit.lab"]), ["record_id", "visit", "lab_instance", "lab",
+                "lab_value"])
+        reshaped = [(".".join(table.groups), values) for table, values in reshaper.reshape([fields])]
+        self.assertEqual([values for name, values in reshaped if name == "visit"], [
+            ["record_id", 1, "visit1", "note1"],
+            ["record_id", 2, "visit2", "note2"],
+        ])
+        self.assertEqual([values for name, values in reshaped if name == "visit.lab"][-1],
+                ["record_id", 2, 2, "visit2_lab2", "visit2_lab_value2"])
+        for name, values in reshaped:
+            self.assertEqual(len(values), len(reshaper.header(tables[name])))
+
+
+class MetadataWriterTest(unittest.TestCase):
+
+    def test_fields(self):
+        matrix = row("pain", kind="radio", label='Pain "today"\nor ever', logic="[visit] = '1'")
+        matrix[redcap_repeat.key['f']] = "1, Yes | 2, No"
+        matrix[redcap_repeat.key['p']] = "symptoms"
+        handle = StringIO()
+        writer = redcap_repeat.MetadataWriter(handle)
+        writer.write(row("field"))
+        writer.write(matrix)
+        # A short row, and a row straight from an expanded group
+        writer.write(["notes", "form_a", "", "notes"])
+        writer.write(redcap_repeat.ExpandedRow(matrix, "pain2", "Pain 2", "[visit_group_no]>=2", "symptoms2"))
+        writer.close()
+        fields = json.loads(handle.getvalue(), object_pairs_hook=OrderedDict)
+        self.assertEqual(len(fields), 3)
+        for field in fields:
+            self.assertEqual(field.keys(), redcap_repeat.metadata_fields)
+        self.assertEqual(fields[0], OrderedDict(zip(redcap_repeat.metadata_fields, matrix + ["", ""])))
+        self.assertEqual(fields[0]["field_label"], 'Pain "today"\nor ever')
+        self.assertEqual(fields[0]["matrix_group_name"], "symptoms")
+        self.assertEqual(fields[1]["field_type"], "notes")
+        self.assertEqual(set(fields[1].values()[4:]), set([""]))
+        self.assertEqual([fields[2][name] for name in ["field_name", "field_label", "branching_logic",
+                "matrix_group_name", "matrix_ranking"]], ["pain2", "Pain 2", "[visit_group_no]>=2", "symptoms2", ""])
+
+
+class GroupCacheTest(unittest.TestCase):
+
+    def test_threads_writing_one_entry(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = GroupCache(directory)
+        rows = [row("med%d" % number) for number in range(200)]
+        errors = []
+
+        def put():
+            try:
+                for attempt in range(20):
+                    cache.put("entry", rows)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=put) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(cache.get("entry"), rows)
+        self.assertEqual(sorted(os.listdir(directory)), ["entry.csv"])
+
+
+class ServiceTest(unittest.TestCase):
+
+    def test_expanders_are_capped(self):
+        service = redcap_repeat.Service(options())
+        request = {"rows": [row("field")] + cross_group}
+        for times in range(1, service.max_expanders + 5):
+            request["options"] = {"max_repeat": times}
+            self.assertFalse("error" in service.handle(request))
+        self.assertEqual(len(service.expanders), service.max_expanders)
+        # The least recently used go first
+        self.assertEqual(min(settings[4] for settings in service.expanders), 5)
+
+    def test_options_a_request_can_set(self):
+        service = redcap_repeat.Service(options())
+        request = {"rows": [row("field")] + cross_group}
+        for overrides, error in [
+                ({"max_repeat": "abc"}, 'The max_repeat option must be a whole number above 0, not "abc"'),
+                ({"max_repeat": True}, "The max_repeat option must be a whole number above 0, not true"),
+                ({"native": 1}, "The native option must be true or false, not 1"),
+                ({"max_fields": 0}, "The max_fields option must be a whole number above 0 or null, not 0"),
+                ({"group_jobs": 4}, "Unknown option 'group_jobs'"),
+                ({"plurals": "/etc/passwd"}, "Unknown option 'plurals'")]:
+            request["options"] = overrides
+            response = service.handle(request)
+            self.assertTrue(response.get("error", "").startswith(error), (overrides, response.get("error")))
+        request["options"] = {"groups": u"items", "max_fields": None, "max_repeat": 3, "prompt": True}
+        self.assertFalse("error" in service.handle(request))
+
+    def test_csv_with_line_breaks_in_cells(self):
+        text = 'field,form,section,type,label\nintro,form_a,,descriptive,"Welcome.\nPlease answer every question."\n'
+        response = redcap_repeat.Service(options()).handle({"csv": text})
+        self.assertEqual(response["rows"][1][:5], ["intro", "form_a", "", "descriptive",
+                "Welcome.\nPlease answer every question."])
+        self.assertEqual(len(response["rows"]), 2)
+
+    def test_responses_are_the_only_output(self):
+        specify = row("smoke 'Other'", kind="details_specify", label="Smoke")
+        specify[redcap_repeat.key['f']] = "1, Yes | 2, Other"
+        requests = [{"id": 1, "rows": [row("field")] + [specify]}, {"id": 2, "csv": "field\nbad"}]
+        output = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            redcap_repeat.Service(options()).serve_lines(StringIO("".join(json.dumps(request) + "\n"
+                    for request in requests)), sys.stdout)
+        finally:
+            lines = sys.stdout.getvalue().splitlines()
+            sys.stdout = output
+        responses = [json.loads(line) for line in lines]
+        self.assertEqual([response["id"] for response in responses], [1, 2])
+        self.assertEqual([line[0] for line in responses[0]["rows"]], ["field", "smoke", "smoke_other_dtls"])
+
+
+class CheckTest(unittest.TestCase):
+
+    def check(self, rows):
+        return redcap_repeat.check([row("field")] + rows, Expander(options()))
+
+    def test_logic_names(self):
+        rows = cross_group + [
+            row("more", logic="[med] <> '' and [dose2] <> ''"),
+            row("early startrepeat 2 Early", logic="[dose] <> ''"),
+            row(" endrepeat", kind=""),
+        ]
+        # Only the plain row refers to a field that just exists inside a group
+        self.assertEqual(self.check(rows), [(7, "Branching logic refers to [med], which is not a field")])
+
+    def test_logic_in_unclosed_group(self):
+        rows = [
+            row("med startrepeat 2 Medication"),
+            row("last", logic="[med] <> ''"),
+        ]
+        self.assertEqual(self.check(rows), [(2, "startrepeat is never closed by an endrepeat, the rest of the"
+                " dictionary is left out")])
+
+
+class CommandLineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, rows):
+        path = os.path.join(self.directory, name)
+        handle = open(path, 'wb')
+        csv.writer(handle).writerows(rows)
+        handle.close()
+        return path
+
+    def run_script(self, *args):
+        script = os.path.join(os.path.dirname(os.path.abspath(redcap_repeat.__file__)), "redcap_repeat.py")
+        process = subprocess.Popen([sys.executable, script] + list(args), stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        return process.returncode, errors
+
+    def test_failure_removes_outputs(self):
+        # The choices have no commas, which is only found after the first rows are written
+        bad = row("smoke", kind="checkbox_details")
+        bad[redcap_repeat.key['f']] = "Yes | No"
+        source = self.write("in.csv", [row("field"), row("first"), bad])
+        output, metadata = os.path.join(self.directory, "out.csv"), os.path.join(self.directory, "out.json")
+        status, errors = self.run_script("--metadata", metadata, source, output)
+        self.assertEqual(status, 1)
+        self.assertTrue("comma" in errors, errors)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["in.csv"])
+
+    def test_output_is_not_the_input(self):
+        source = self.write("in.csv", [row("field"), row("first")])
+        status, errors = self.run_script(source, os.path.join(self.directory, ".", "in.csv"))
+        self.assertEqual(status, 2)
+        self.assertTrue("can't be the input file" in errors, errors)
+        self.assertEqual(len(open(source).read().splitlines()), 2)
+
+    def test_batch_outputs_are_not_inputs(self):
+        self.write("in.csv", [row("field"), row("first")])
+        self.assertRaises(RepeatError, redcap_repeat.batch_pairs, [self.directory, self.directory + os.sep])
+        manifest = self.write("manifest.csv", [["in.csv", "out.csv"], ["out.csv", "in.csv"]])
+        self.assertRaises(RepeatError, redcap_repeat.batch_pairs, [manifest])
+        status, errors = self.run_script("-b", self.directory, self.directory)
+        self.assertEqual(status, 2)
+        self.assertTrue("can't be the input directory" in errors, errors)
+        output_dir = os.path.join(self.directory, "out")
+        self.assertEqual(redcap_repeat.batch_pairs([self.directory, output_dir]),
+                [(os.path.join(self.directory, name), os.path.join(output_dir, name))
+                for name in ["in.csv", "manifest.csv"]])
+
+
+class SimplifyLogicTest(unittest.TestCase):
+
+    def run_table(self, table):
+        for logic, simplified in table:
+            self.assertEqual(redcap_repeat.simplify_logic(logic), simplified, logic)
+
+    def test_redundant_bounds(self):
+        self.run_table([
+            ("[n]>=3 and [n]>=2", "[n]>=3"),
+            ("[n]>=2 and [n]>=3", "[n]>=3"),
+            ("[n]>=2 and [n]>2", "[n]>2"),
+            ("[n]<5 and [n]<3", "[n]<3"),
+            ("[n(1)]='1' and [n]>=2.5 and [n]>=2", "[n(1)]='1' and [n]>=2.5"),
+            ("[n]>=2 or [n]>=3", "[n]>=2"),
+            # Bounds on other fields or in the other direction say something of their own
+            ("[n]>=3 and [m]>=2", "[n]>=3 and [m]>=2"),
+            ("[n]>=3 and [n]<=5", "[n]>=3 and [n]<=5"),
+            # A bound only covers one in the same and/or
+            ("[n]>=3 and ([n]>=2 or [a]='1')", "[n]>=3 and ([n]>=2 or [a]='1')"),
+            ("[n]>=2 or [n]>=3 and [a]='1'", "[n]>=2 or [n]>=3 and [a]='1'"),
+        ])
+
+    def test_repeated_terms(self):
+        self.run_table([
+            ("[a]='1' and [a]='1'", "[a]='1'"),
+            ("[a]='this and that' and [a]='this and that'", "[a]='this and that'"),
+            ("([a]='1' and [b]='1') and [c]='1'", "[a]='1' and [b]='1' and [c]='1'"),
+            ("[a]='1' AND [b]='1'", "[a]='1' and [b]='1'"),
+        ])
+
+    def test_precedence(self):
+        self.run_table([
+            ("([a]='1' or [b]='1') and [c]='1'", "([a]='1' or [b]='1') and [c]='1'"),
+            ("[a]='1' and [b]='1' or [c]='1'", "[a]='1' and [b]='1' or [c]='1'"),
+            ("[a]='1' or ([b]='1' and [c]='1')", "[a]='1' or [b]='1' and [c]='1'"),
+        ])
+
+    def test_parentheses(self):
+        self.run_table([
+            ("([a] = '1') and [n]>=2", "[a] = '1' and [n]>=2"),
+            ("(([a] = '1'))", "[a] = '1'"),
+            ("([a]='1' or [b]='1')", "[a]='1' or [b]='1'"),
+            ("datediff([d1],'today','d')>7 and [n]>=1", "datediff([d1],'today','d')>7 and [n]>=1"),
+        ])
+
+    def test_unparsed_logic_is_unchanged(self):
+        self.run_table([(logic, logic) for logic in [
+            "",
+            "   ",
+            "([a]='1'",
+            "[a]='1' and",
+            "([a]+1)>2 and [n]>=1",
+        ]])
+
+
+class StubRedcap(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A REDCap API on a local port. Exports send back the dictionary of the source token, imports are kept by
+    target token and content. Any status codes in responses are sent first, one per request. With hold, exports
+    wait until two are in at once (or a second has gone by), so that exports running side by side are seen
+    side by side."""
+    daemon_threads = True
+
+    def __init__(self, dictionaries, responses=()):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.url = "http://127.0.0.1:%d/api/" % self.server_address[1]
+        self.dictionaries = dictionaries
+        self.responses = list(responses)
+        self.requests = []
+        self.imports = {}
+        self.lock = threading.Condition()
+        self.hold = False
+        self.exporting = 0
+        self.most_exporting = 0
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def export(self, token):
+        with self.lock:
+            self.exporting += 1
+            self.most_exporting = max(self.most_exporting, self.exporting)
+            self.lock.notify_all()
+            waited = time.time()
+            while self.hold and self.most_exporting < 2 and time.time() - waited < 1.0:
+                self.lock.wait(0.05)
+        with self.lock:
+            self.exporting -= 1
+        fields = [dict(zip(redcap_repeat.metadata_fields, line)) for line in self.dictionaries[token]]
+        return 200, json.dumps(fields)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        fields = dict(urlparse.parse_qsl(self.rfile.read(int(self.headers['content-length']))))
+        with server.lock:
+            server.requests.append((time.time(), fields))
+            status = server.responses.pop(0) if server.responses else None
+        if status is not None:
+            body = "stub error"
+        elif fields['token'] in server.dictionaries:
+            status, body = server.export(fields['token'])
+        else:
+            with server.lock:
+                server.imports[(fields['token'], fields['content'])] = json.loads(fields['data'])
+            status, body = 200, "1"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RedcapApiTest(unittest.TestCase):
+
+    def serve(self, dictionaries, responses=()):
+        server = StubRedcap(dictionaries, responses)
+        self.addCleanup(server.stop)
+        return server
+
+    def test_retries_server_errors(self):
+        server = self.serve({"src": cross_group}, [500, 429, 503])
+        rows = RedcapApi(retries=3, backoff=0.05).export_metadata(server.url, "src")
+        self.assertEqual([line[0] for line in rows[1:]], [line[0] for line in cross_group])
+        # Each try waits twice as long as the one before
+        times = [sent for sent, fields in server.requests]
+        waits = [later - earlier for earlier, later in zip(times, times[1:])]
+        self.assertEqual(len(waits), 3)
+        for wait, backoff in zip(waits, [0.05, 0.1, 0.2]):
+            self.assertTrue(wait >= backoff, "waited %.3fs, expected %.3fs" % (wait, backoff))
+
+    def test_gives_up_after_retries(self):
+        server = self.serve({"src": cross_group}, [500, 500, 500])
+        self.assertRaises(RepeatError, RedcapApi(retries=2, backoff=0.01).export_metadata, server.url, "src")
+        self.assertEqual(len(server.requests), 3)
+
+    def test_fails_on_client_errors(self):
+        for status in (400, 403, 404):
+            server = self.serve({"src": cross_group}, [status])
+            try:
+                RedcapApi(retries=3, backoff=5).export_metadata(server.url, "src")
+                self.fail("a %d was retried" % status)
+            except RepeatError, e:
+                self.assertTrue("refused" in str(e) and str(status) in str(e))
+            self.assertEqual(len(server.requests), 1)
+
+    def test_batch(self):
+        dictionaries = {}
+        projects = []
+        for number in range(4):
+            times = number + 2
+            dictionaries["src%d" % number] = [row("med startrepeat %d Medication" % times)] + cross_group[1:]
+            projects.append((number + 1, None, "src%d" % number, "dst%d" % number))
+        # The first export fails once and is retried
+        server = self.serve(dictionaries, [500])
+        server.hold = True
+        projects = [(number, server.url, source, target) for number, url, source, target in projects]
+        expander = Expander(options())
+
+        output = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            failures = redcap_repeat.api_batch(projects, 3, expander, RedcapApi(retries=2, backoff=0.01))
+        finally:
+            summary = sys.stdout.getvalue()
+            sys.stdout = output
+        self.assertEqual(failures, 0, summary)
+        self.assertTrue(server.most_exporting >= 2)
+
+        for number in range(4):
+            source = [redcap_repeat.metadata_fields[:]] + dictionaries["src%d" % number]
+            handle = StringIO()
+            writer = redcap_repeat.MetadataWriter(handle)
+            for line in expander.expand(source):
+                writer.write(line)
+            writer.close()
+            pushed = server.imports[("dst%d" % number, "metadata")]
+            self.assertEqual(pushed, json.loads(handle.getvalue()))
+            self.assertEqual([field["branching_logic"] for field in pushed if field["field_name"] == "visit_group_no"],
+                    ["[last%d] = '1'" % (number + 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()